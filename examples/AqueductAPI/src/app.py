@@ -1,7 +1,9 @@
 from flask_restx import Resource, Api, fields, Namespace
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
 import socket
+from urllib.parse import urlencode
+import json
 from lib.Aqueduct import AqueductAMQP, Pipelines, subscribe
 import os
 import logging
@@ -11,6 +13,8 @@ AMPQ_HOST = os.getenv('AMPQ_HOST', 'rabbitmq')
 AMPQ_PORT = os.getenv('AMPQ_PORT', '5672')
 AMPQ_USER = os.getenv('AMPQ_USER', 'guest')
 AMPQ_PASSWORD = os.getenv('AMPQ_PASSWORD', 'guest')
+# Seconds between keep alives of idle status streams
+KEEPALIVE_INTERVAL = 15
 
 logger = logging.getLogger(__name__)
 
@@ -94,10 +98,64 @@ class DeletePipeline(Resource):
         pipelines_manager.delete(source_id)
         return {'message': f'Deleted pipeline {source_id}.'}, 200
 
+status_parser = ns.parser()
+status_parser.add_argument('status', type=str, help='Comma separated statuses')
+status_parser.add_argument('source', type=str, help='Comma separated pipeline source files')
+status_parser.add_argument('since', type=int, help='Minimum lastStatusUpdate timestamp')
+status_parser.add_argument('until', type=int, help='Maximum lastStatusUpdate timestamp')
+status_parser.add_argument('cursor', type=str, help='Cursor of the page, from X-Next-Cursor')
+status_parser.add_argument('limit', type=int, help='Maximum pipelines per page')
+
+def etag_matches(etag, if_none_match):
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    return etag in tags or '*' in tags
+
 @ns.route('/status')
 class Status(Resource):
+    @ns.expect(status_parser)
+    def get(self):
+        """
+        Status of the pipelines matching the filters. A page with more pipelines
+        after it returns the cursor of the next one in X-Next-Cursor and Link.
+        """
+        args = status_parser.parse_args()
+        if args['limit'] is not None and args['limit'] < 1:
+            return {'message': 'limit must be positive'}, 400
+        filters = (args['status'].split(',') if args['status'] else None,
+                   args['source'].split(',') if args['source'] else None,
+                   args['since'], args['until'], args['cursor'], args['limit'])
+        headers = {'ETag': pipelines_manager.queryETag(*filters)}
+        if etag_matches(headers['ETag'], request.headers.get('If-None-Match', '')):
+            return '', 304, headers
+        try:
+            pipelines, next_cursor = pipelines_manager.query(*filters)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+        if next_cursor is not None:
+            headers['X-Next-Cursor'] = next_cursor
+            headers['Link'] = f'<{request.base_url}?{urlencode({**request.args.to_dict(), "cursor": next_cursor})}>; rel="next"'
+        return pipelines, 200, headers
+
+@ns.route('/status/stream')
+class StatusStream(Resource):
     def get(self):
-        return pipelines_manager.getDB()
+        """
+        Server-sent events with the status changes of the pipelines, resumed
+        from the Last-Event-ID header or the resume parameter.
+        """
+        token = request.headers.get('Last-Event-ID', request.args.get('resume'))
+
+        def events(token):
+            while True:
+                batch, token = pipelines_manager.statusEvents(token)
+                for id, event, data in batch:
+                    yield f"id: {id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                if not pipelines_manager.changes.wait(token, KEEPALIVE_INTERVAL):
+                    yield ": keepalive\n\n"
+
+        return Response(stream_with_context(events(token)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @ns.route('/status/<string:sourceId>')
 class StatusById(Resource):
@@ -0,0 +1,223 @@
+from fastapi import FastAPI, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional, Union
+from contextlib import asynccontextmanager
+import asyncio
+import socket
+import json
+import uvicorn
+from lib.Aqueduct import Pipelines
+from lib.AsyncAMQP import AsyncAqueductAMQP, connect
+import os
+import logging
+
+FLASK_PORT = os.getenv('FLASK_PORT', '8888')
+AMPQ_HOST = os.getenv('AMPQ_HOST', 'rabbitmq')
+AMPQ_PORT = os.getenv('AMPQ_PORT', '5672')
+AMPQ_USER = os.getenv('AMPQ_USER', 'guest')
+AMPQ_PASSWORD = os.getenv('AMPQ_PASSWORD', 'guest')
+# Seconds to wait for pipelines to start or stop
+WAIT_TIMEOUT = 20
+# Seconds between keep alives of idle status streams
+KEEPALIVE_INTERVAL = 15
+
+SUPPORTED_PIPELINES = ["VehicleAnalytics", "TrafficAnalytics"]
+
+logger = logging.getLogger(__name__)
+
+class StartPipelineModel(BaseModel):
+    sourceId: str = Field(description='Source ID')
+    pipeline: str = Field(description='Pipeline Name')
+    URL: str = Field(description='RTSP URL')
+    extra_parameters: dict = Field(default_factory=dict, description='Extra Parameters')
+
+class StopPipelineModel(BaseModel):
+    sourceId: str = Field(description='Source ID to stop')
+
+# All publishing and the status subscription share a single AMQP connection,
+# with a channel each, and run on the event loop
+connection = None
+send_publisher = None
+subscribe_publisher = None
+subscriber_task = None
+
+pipelines_manager = Pipelines(".", "./db.json", None, logger)
+
+def onAqueductUpdate(ch, method, properties, body):
+    pipelines_manager.handle_message(False, method, properties, body)
+
+@asynccontextmanager
+async def lifespan(app):
+    global connection, send_publisher, subscribe_publisher, subscriber_task
+    socket.gethostbyname(AMPQ_HOST)
+    connection = await connect(AMPQ_HOST, AMPQ_PORT, AMPQ_USER, AMPQ_PASSWORD)
+    send_publisher = AsyncAqueductAMQP("send", AMPQ_HOST, AMPQ_PORT, AMPQ_USER, AMPQ_PASSWORD, logger, connection)
+    subscribe_publisher = AsyncAqueductAMQP("subscribe", AMPQ_HOST, AMPQ_PORT, AMPQ_USER, AMPQ_PASSWORD, logger, connection)
+    await send_publisher.connect()
+    await subscribe_publisher.connect()
+    subscriber_task = asyncio.create_task(
+        subscribe_publisher.subscribe(onAqueductUpdate, exchange="aqueduct", topic='everything'))
+    yield
+    subscriber_task.cancel()
+    await connection.close()
+    pipelines_manager.close()
+
+app = FastAPI(version='1.0', title='Pipeline API', description='API for Managing Pipelines', lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+def pipeline_definition(data):
+    source_id = data.sourceId
+    return {
+        "pipeline": f"./share/pipelines/{data.pipeline}/{data.pipeline}RTSP.yaml",
+        "parameters": {
+            "VIDEO_IN": data.URL,
+            "sourceId": source_id,
+            "recordTo": f"/data/sighthound/media/output/video/{source_id}/",
+            "imageSaveDir": f"/data/sighthound/media/output/image/{source_id}/",
+            "amqpHost": "rabbitmq",
+            "amqpPort": "5672",
+            "amqpExchange": "anypipe",
+            "amqpUser": "guest",
+            "amqpPassword": "guest",
+            "amqpErrorOnFailure": "true",
+            **data.extra_parameters
+        }
+    }
+
+@app.post('/pipelines/start', tags=['pipelines'])
+async def start_pipelines(data: Union[StartPipelineModel, List[StartPipelineModel]]):
+    """
+    Start a pipeline, or a list of pipelines in a single request. A list gets
+    a message per pipeline, keyed by sourceId.
+    """
+    batch = isinstance(data, list)
+    requests = data if batch else [data]
+    errors = {}
+    pipelines = {}
+    for request in requests:
+        source_id = request.sourceId
+        if pipelines_manager.exists(source_id) or source_id in pipelines:
+            errors[source_id] = f'Pipeline {source_id} already exists.'
+        elif request.pipeline not in SUPPORTED_PIPELINES:
+            errors[source_id] = f'Pipeline {request.pipeline} not supported.'
+        else:
+            pipelines[source_id] = pipeline_definition(request)
+    if not batch and errors:
+        return JSONResponse({'message': errors[requests[0].sourceId]}, status_code=400)
+
+    results = {source_id: {'message': message, 'started': False} for source_id, message in errors.items()}
+    if pipelines:
+        accepted = await pipelines_manager.runAsync(pipelines, send_publisher)
+        waiting = [source_id for source_id, result in accepted.items() if result is True]
+        started = await pipelines_manager.waitPipelinesAsync(waiting, ["start", "done"], WAIT_TIMEOUT)
+        for source_id in pipelines:
+            status = pipelines_manager.status(source_id)
+            if started.get(source_id, False):
+                results[source_id] = {'message': f'Started pipeline {source_id}. Status: {status}.', 'started': True}
+            else:
+                results[source_id] = {'message': f'Pipeline {source_id} failed to start. Latest status {status}.', 'started': False}
+
+    all_started = all(result['started'] for result in results.values())
+    if not batch:
+        return JSONResponse({'message': results[requests[0].sourceId]['message']}, status_code=200 if all_started else 500)
+    return JSONResponse({'results': results}, status_code=200 if all_started else 500)
+
+@app.post('/pipelines/stop', tags=['pipelines'])
+async def stop_pipeline(data: StopPipelineModel):
+    source_id = data.sourceId
+    await pipelines_manager.stopPipelinesAsync([source_id], send_publisher)
+    if not await pipelines_manager.waitPipelineAsync(source_id, ["stop", "done"], WAIT_TIMEOUT):
+        return JSONResponse({'message': f'Pipeline {source_id} failed to stop. Latest status {pipelines_manager.status(source_id)}.'}, status_code=500)
+
+    return {'message': f'Stopped pipeline {source_id}. Status: {pipelines_manager.status(source_id)}.'}
+
+@app.post('/pipelines/delete', tags=['pipelines'])
+async def delete_pipeline(data: StopPipelineModel):
+    source_id = data.sourceId
+    await pipelines_manager.deletePipelineAsync(source_id, send_publisher)
+    return {'message': f'Deleted pipeline {source_id}.'}
+
+def etag_matches(etag, if_none_match):
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    return etag in tags or '*' in tags
+
+@app.get('/pipelines/status', tags=['pipelines'])
+async def status(request: Request,
+                 status: Optional[str] = Query(None, description='Comma separated statuses'),
+                 source: Optional[str] = Query(None, description='Comma separated pipeline source files'),
+                 since: Optional[int] = Query(None, description='Minimum lastStatusUpdate timestamp'),
+                 until: Optional[int] = Query(None, description='Maximum lastStatusUpdate timestamp'),
+                 cursor: Optional[str] = Query(None, description='Cursor of the page, from X-Next-Cursor'),
+                 limit: Optional[int] = Query(None, ge=1, description='Maximum pipelines per page')):
+    """
+    Status of the pipelines matching the filters. A page with more pipelines
+    after it returns the cursor of the next one in X-Next-Cursor and Link.
+    """
+    filters = (status.split(',') if status else None, source.split(',') if source else None,
+               since, until, cursor, limit)
+    headers = {'ETag': pipelines_manager.queryETag(*filters)}
+    if etag_matches(headers['ETag'], request.headers.get('if-none-match', '')):
+        return Response(status_code=304, headers=headers)
+    try:
+        pipelines, next_cursor = pipelines_manager.query(*filters)
+    except ValueError as e:
+        return JSONResponse({'message': str(e)}, status_code=400)
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = next_cursor
+        headers['Link'] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    return JSONResponse(pipelines, headers=headers)
+
+@app.get('/pipelines/status/stream', tags=['pipelines'])
+async def status_stream(request: Request, resume: Optional[str] = None):
+    """
+    Server-sent events with the status changes of the pipelines. The first event
+    is a snapshot of all pipelines, unless the resume token of the last event
+    seen is given in the Last-Event-ID header or the resume parameter.
+    """
+    token = request.headers.get('last-event-id', resume)
+
+    async def events():
+        nonlocal token
+        while not await request.is_disconnected():
+            batch, token = pipelines_manager.statusEvents(token)
+            for id, event, data in batch:
+                yield f"id: {id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+            if not await pipelines_manager.changes.wait_async(token, KEEPALIVE_INTERVAL):
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.websocket('/pipelines/status/ws')
+async def status_websocket(websocket: WebSocket, resume: Optional[str] = None):
+    """
+    WebSocket version of the status stream, every event is sent as a
+    {"id", "event", "data"} JSON message. A {"event": "keepalive"} message is
+    sent when nothing changed for KEEPALIVE_INTERVAL, which also ends the
+    stream of a client gone without closing the connection.
+    """
+    await websocket.accept()
+    token = resume
+    try:
+        while True:
+            batch, token = pipelines_manager.statusEvents(token)
+            for id, event, data in batch:
+                await websocket.send_json({'id': id, 'event': event, 'data': data})
+            if not await pipelines_manager.changes.wait_async(token, KEEPALIVE_INTERVAL):
+                await websocket.send_json({'event': 'keepalive'})
+    except WebSocketDisconnect:
+        pass
+
+@app.get('/pipelines/status/{sourceId}', tags=['pipelines'])
+async def status_by_id(sourceId: str):
+    return pipelines_manager.status(sourceId)
+
+@app.get('/health')
+async def health():
+    return {'message': 'Ok'}
+
+if __name__ == '__main__':
+    uvicorn.run(app, host='0.0.0.0', port=int(FLASK_PORT))
@@ -4,8 +4,12 @@ import time
 import argparse
 import logging
 import socket
-from datetime import datetime
-from lib.Aqueduct import AqueductAMQP, Pipelines, subscribe
+import asyncio
+from threading import Thread
+from lib.Aqueduct import AqueductAMQP, Pipelines, PipelinesFolderWatcher, subscribe
+from lib.AsyncAMQP import AsyncAqueductAMQP
+from lib.Recorder import JSONLRecorder
+from lib.Replay import ReplayPublisher
 
 logger = logging.getLogger("aqueduct")
 
@@ -16,21 +20,49 @@ parser.add_argument( '-log',
                     default='info',
                     help='Provide logging level. Example --loglevel debug, default=info' )
 parser.add_argument('--pipelinesDir', "-d",  help='Folder to watch for pipeline files', default='./pipelines')
-parser.add_argument('--pipelinesDBFile', help='', default='./db.json')
+parser.add_argument('--pipelinesDBFile', help='Pipelines db file, .sqlite/.sqlite3/.db files use SQLite, any other JSON', default='./db.json')
 parser.add_argument('--amqpHost', help='AMQP host', default='rabbitmq')
 parser.add_argument('--amqpPort', help='AMQP port', default=5672, type=int)
 parser.add_argument('--amqpUsername','-u', help='AMQP username', default='guest')
 parser.add_argument('--amqpPassword', '-p', help='AMQP password', default='guest')
-parser.add_argument('--sleep', help='Sleep time between loops', default=10, type=int)
+parser.add_argument('--sleep', help='Sleep time between loops, in folderwatch mode the maximum time between folder scans', default=10, type=int)
+parser.add_argument('--refresh', help='Seconds between redraws of the pipelines view in watch and folderwatch modes', default=1.0, type=float)
 parser.add_argument('--timeout', help='Max timeout for start and stop operations. Zero means infinite', default=0, type=int)
-parser.add_argument('--json_dump', help='Dump AMQP messages to json file', default="", type=str)
-parser.add_argument('command', help='Command to run', choices=['update', 'folderwatch', 'watch', 'run', 'stop', 'ps'])
+parser.add_argument('--json_dump', help='Dump anypipe AMQP messages to json lines file in run, watch and folderwatch modes', default="", type=str)
+parser.add_argument('--json_dump_compression', help='Compression of the json dump files', default='none', choices=['none', 'gzip', 'zstd'])
+parser.add_argument('--json_dump_max_mb', help='Rotate json dump files once they reach this size in MB, zero disables', default=0, type=float)
+parser.add_argument('--json_dump_rotate_seconds', help='Rotate json dump files after this many seconds, zero disables', default=0, type=int)
+parser.add_argument('--json_dump_split', help='Dump the messages of each sourceId to its own files', action='store_true')
+parser.add_argument('--json_dump_queue', help='Maximum messages waiting to be written, more are dropped', default=100000, type=int)
+parser.add_argument('--status', help='ps: only pipelines with one of these comma separated statuses', default=None, type=str)
+parser.add_argument('--source', help='ps: only pipelines from one of these comma separated pipeline files', default=None, type=str)
+parser.add_argument('--since', help='ps: only pipelines with a status update at or after this timestamp', default=None, type=int)
+parser.add_argument('--until', help='ps: only pipelines with a status update at or before this timestamp', default=None, type=int)
+parser.add_argument('--limit', help='ps: maximum pipelines to list', default=None, type=int)
+parser.add_argument('--cursor', help='ps: cursor of the page to list, printed by the previous page', default=None, type=str)
+parser.add_argument('--replay_speed', help='replay: speed relative to the recording, zero publishes as fast as possible', default=1.0, type=float)
+parser.add_argument('--replay_routing_key', help='replay: routing key of the published messages', default='sio', type=str)
+parser.add_argument('command', help='Command to run', choices=['update', 'folderwatch', 'watch', 'run', 'stop', 'ps', 'import', 'export', 'replay'])
 parser.add_argument('args', help='Arguments to pass to the command', nargs='*')
 
 def help():
     parser.print_help(sys.stderr)
     sys.exit(1)
 
+class BulkLauncher:
+    """
+    Runs an asyncio publisher on a background event loop, used to launch
+    pipelines in bulk with publisher confirms.
+    """
+    def __init__(self, args, logger):
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        self.publisher = AsyncAqueductAMQP("launch", args.amqpHost, args.amqpPort, args.amqpUsername, args.amqpPassword, logger)
+        self.run(self.publisher.connect())
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
 def main(args, logger):
     logger.debug('Starting aqueduct runner...')    
 
@@ -52,67 +84,116 @@ def main(args, logger):
         return
 
     pipelines = Pipelines(args.pipelinesDir, args.pipelinesDBFile, send_publisher, logger)
+    launcher = None
+    if args.command in ['update', 'folderwatch', 'run']:
+        try:
+            launcher = BulkLauncher(args, logger)
+        except Exception as e:
+            logger.error('Failed to connect to AMQP: %s', e)
+            return
     watch_mode = args.command in ['watch', 'folderwatch']
     def onAqueductUpdate(ch, method, properties, body):
         pipelines.handle_message(watch_mode, method, properties, body)
     def onAnypipeMessage(ch, method, properties, body):
-        pipelines.anypipe_message(method, properties, body, args.json_dump)
+        pipelines.anypipe_message(method, properties, body, recorder)
+
+    recorder = None
+    if args.json_dump != "" and args.command in ['run', 'watch', 'folderwatch']:
+        recorder = JSONLRecorder({
+            "path": args.json_dump,
+            "compression": args.json_dump_compression,
+            "max_bytes": int(args.json_dump_max_mb * 1024 * 1024),
+            "rotate_seconds": args.json_dump_rotate_seconds,
+            "split_by_source": args.json_dump_split,
+            "queue_size": args.json_dump_queue,
+        }).start()
+        subscribe(anypipe_publisher, onAnypipeMessage, background=True, exchange="anypipe", topic='everything')
 
     if args.command == 'update':
         logger.info('Running update once...')
         subscribe(subscribe_publisher, onAqueductUpdate, background=True, exchange="aqueduct", topic='everything')
-        pipelines.runFolderWatch()
+        launcher.run(pipelines.runFolderWatchAsync(launcher.publisher))
         time.sleep(args.sleep)
     elif args.command == 'watch':
         logger.info('Running in watch mode...')
-        pipelines.print_pipelines_db(datetime.now().strftime("%H:%M:%S"), pipelines.getDB(), clear=True)
+        pipelines.watch(args.refresh)
         subscribe(subscribe_publisher, onAqueductUpdate, background=False, exchange="aqueduct", topic='everything')
 
     elif args.command == 'folderwatch':
         logger.info('Running in folderwatch mode...')
+        view = pipelines.watch(args.refresh)
         subscribe(subscribe_publisher, onAqueductUpdate, background=True, exchange="aqueduct", topic='everything')
-        # Send constant updates
+        watcher = PipelinesFolderWatcher(args.pipelinesDir, logger, pipelines.index)
+        # Only send the pipelines which changed since the last scan
         while True:
-            pipelines.print_pipelines_db(datetime.now().strftime("%H:%M:%S"), pipelines.getDB(), clear=True)
-            pipelines.runFolderWatch()
-            logger.debug('Sleeping for %s seconds', args.sleep)
-            time.sleep(args.sleep)
+            launcher.run(pipelines.runFolderWatchChangesAsync(watcher, launcher.publisher))
+            view.refresh()
+            logger.debug('Waiting up to %s seconds for changes', args.sleep)
+            watcher.wait(args.sleep)
     elif args.command == 'run':
-        if len(args) < 1:
+        if len(args.args) < 1:
             logger.error('No pipeline file provided')
             logger.info('Example: aqueductRunner run pipeline.json')
             raise Exception('No pipeline file provided')
-        elif len(args) > 1:
+        elif len(args.args) > 1:
             logger.error('Too many arguments')
             logger.info('Example: aqueductRunner run pipeline.json')
             raise Exception('Too many arguments')
         subscribe(subscribe_publisher, onAqueductUpdate, background=True, exchange="aqueduct", topic='everything')
-        if args.json_dump != "":
-            subscribe(anypipe_publisher, onAnypipeMessage, background=True, exchange="anypipe", topic='everything')
         logger.info('Running pipeline')
-        pipelines.run_from_file(args[0])
-        pipelines.wait(args[0], args.timeout)
+        launcher.run(pipelines.runFromFileAsync(args.args[0], launcher.publisher))
+        pipelines.wait(args.args[0], ["start", "done"], args.timeout)
     elif args.command == 'stop':
-        if len(args) < 1:
+        if len(args.args) < 1:
             logger.error('No pipeline file or id provided')
             logger.info('Example: aqueductRunner stop pipeline_id/pipeline.json')
             return
-        elif len(args) > 1:
+        elif len(args.args) > 1:
             logger.error('Too many arguments')
             logger.info('Example: aqueductRunner stop pipeline_id/pipeline.json')
             return
         subscribe(subscribe_publisher, onAqueductUpdate, background=True, exchange="aqueduct", topic='everything')
         logger.info('Stopping pipeline')
-        pipelines.stop(args[0])
-        pipelines.wait(args[0], args.timeout)
+        pipelines.stop(args.args[0])
+        pipelines.wait(args.args[0], ["stop", "done"], args.timeout)
     elif args.command == 'ps':
         logger.debug('Listing pipelines')
-        pipelines.ps()
+        pipelines.ps(args.status.split(',') if args.status else None,
+                     args.source.split(',') if args.source else None,
+                     args.since, args.until, args.cursor, args.limit)
+    elif args.command in ['import', 'export']:
+        if len(args.args) != 1:
+            logger.error('A single JSON db file is required')
+            logger.info('Example: aqueductRunner --pipelinesDBFile db.sqlite %s db.json', args.command)
+            return
+        if args.command == 'import':
+            logger.info('Importing pipelines db from %s', args.args[0])
+            pipelines.importDB(args.args[0])
+        else:
+            logger.info('Exporting pipelines db to %s', args.args[0])
+            pipelines.exportDB(args.args[0])
+    elif args.command == 'replay':
+        if len(args.args) < 1:
+            logger.error('No recording provided')
+            logger.info('Example: aqueductRunner --replay_speed 2 replay anypipe.jsonl')
+            return
+        ReplayPublisher({
+            "files": args.args,
+            "speed": args.replay_speed,
+            "routing_key": args.replay_routing_key,
+            "host": args.amqpHost,
+            "port": args.amqpPort,
+            "username": args.amqpUsername,
+            "password": args.amqpPassword,
+        }).start()
     else:
         logger.error('Unimplemented command: %s', args.command)
         help()
 
     logger.debug('Shutting down...')
+    pipelines.close()
+    if recorder is not None:
+        recorder.close()
 
     # send_publisher.close()
     # subscribe_publisher.close()
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import traceback
+from threading import Thread, Condition
+
+class JobFailed(Exception):
+    """
+    Raised by a handler to fail a job without retrying it.
+    """
+    pass
+
+class CaptureQueue:
+    """
+    Persistent queue of capture jobs in a SQLite database, run by a pool of
+    worker threads. At most per_source jobs of a source run at once, failed
+    jobs are retried with an exponential backoff until max_attempts, then
+    kept as failed. Jobs interrupted by a restart run again on the next start.
+    """
+    path = 'capture_jobs.sqlite'
+    workers = 2
+    # Maximum jobs of the same source running at once
+    per_source = 1
+    # Attempts of a job before it's marked failed
+    max_attempts = 5
+    # Seconds before the first retry, doubled on each following one
+    retry_delay = 5
+    max_retry_delay = 300
+
+    STATES = ['pending', 'running', 'failed']
+
+    def __init__(self, conf, handler):
+        """
+        @param handler is called with the (source, payload) of each job and
+        raises to fail it, JobFailed to not retry it.
+        """
+        self.path = conf.get("path", CaptureQueue.path)
+        self.workers = int(conf.get("workers", CaptureQueue.workers))
+        self.per_source = int(conf.get("per_source", CaptureQueue.per_source))
+        self.max_attempts = int(conf.get("max_attempts", CaptureQueue.max_attempts))
+        self.retry_delay = float(conf.get("retry_delay", CaptureQueue.retry_delay))
+        self.max_retry_delay = float(conf.get("max_retry_delay", CaptureQueue.max_retry_delay))
+        self.handler = handler
+        self._condition = Condition()
+        self._conn = None
+        # sourceId -> jobs running
+        self._running = {}
+        self._threads = []
+        self._stopping = False
+
+    def _connection(self):
+        # A single connection, only used with the condition lock held
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            with self._conn:
+                self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                      source TEXT NOT NULL,
+                                      state TEXT NOT NULL,
+                                      attempts INTEGER NOT NULL DEFAULT 0,
+                                      next_attempt REAL NOT NULL,
+                                      created REAL NOT NULL,
+                                      updated REAL NOT NULL,
+                                      error TEXT,
+                                      payload TEXT NOT NULL)""")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, next_attempt)")
+        return self._conn
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return self
+            conn = self._connection()
+            with conn:
+                resumed = conn.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'").rowcount
+            counts = self.counts()
+            self._stopping = False
+        print(f"Capture queue {self.path}: {counts['pending']} pending jobs ({resumed} interrupted), {counts['failed']} failed")
+        for i in range(self.workers):
+            thread = Thread(target=self._work_loop, name=f"capture-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, source, payload):
+        """
+        Queue a job for @param source with the JSON serializable @param payload.
+        Returns the job id.
+        """
+        now = time.time()
+        with self._condition:
+            conn = self._connection()
+            with conn:
+                id = conn.execute("INSERT INTO jobs (source, state, next_attempt, created, updated, payload) VALUES (?, 'pending', ?, ?, ?, ?)",
+                                  (source, now, now, now, json.dumps(payload))).lastrowid
+            self._condition.notify()
+        return id
+
+    def _next_job(self):
+        """
+        Return the oldest runnable job, marked running, or the seconds to wait
+        for the next one to be due, None when no job is pending.
+        """
+        now = time.time()
+        conn = self._connection()
+        busy = [source for source, running in self._running.items() if running >= self.per_source]
+        row = conn.execute(f"""SELECT * FROM jobs WHERE state = 'pending' AND next_attempt <= ?
+                               AND source NOT IN ({','.join('?' * len(busy))}) ORDER BY id LIMIT 1""", [now] + busy).fetchone()
+        if row is None:
+            due = conn.execute("SELECT MIN(next_attempt) FROM jobs WHERE state = 'pending'").fetchone()[0]
+            return None if due is None else max(due - now, 0.1)
+        with conn:
+            conn.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, updated = ? WHERE id = ?", (now, row["id"]))
+        self._running[row["source"]] = self._running.get(row["source"], 0) + 1
+        return row
+
+    def _finish(self, row, error, retry=True):
+        now = time.time()
+        conn = self._connection()
+        attempts = row["attempts"] + 1
+        with conn:
+            if error is None:
+                conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+            elif not retry or attempts >= self.max_attempts:
+                conn.execute("UPDATE jobs SET state = 'failed', updated = ?, error = ? WHERE id = ?", (now, error, row["id"]))
+                print(f"Capture job {row['id']} of {row['source']} failed after {attempts} attempts: {error}")
+            else:
+                delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+                conn.execute("UPDATE jobs SET state = 'pending', next_attempt = ?, updated = ?, error = ? WHERE id = ?",
+                             (now + delay, now, error, row["id"]))
+                print(f"Capture job {row['id']} of {row['source']} failed, retrying in {delay:.1f}s: {error}")
+        self._running[row["source"]] -= 1
+        self._condition.notify_all()
+
+    def _work_loop(self):
+        while True:
+            with self._condition:
+                row = None
+                while not self._stopping:
+                    row = self._next_job()
+                    if not isinstance(row, sqlite3.Row):
+                        self._condition.wait(row)
+                        row = None
+                    else:
+                        break
+                if row is None:
+                    return
+            error = None
+            retry = True
+            try:
+                self.handler(row["source"], json.loads(row["payload"]))
+            except JobFailed as e:
+                error = str(e)
+                retry = False
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                traceback.print_exc()
+            with self._condition:
+                self._finish(row, error, retry)
+
+    def join(self, timeout=None):
+        """
+        Wait until no job is pending or running, returns False on @param timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while True:
+                counts = self.counts()
+                if counts['pending'] == 0 and counts['running'] == 0:
+                    return True
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(1 if remaining is None else min(remaining, 1))
+
+    def stop(self, timeout=None):
+        """
+        Stop the workers once their running jobs are done, the pending jobs
+        are kept for the next start. The jobs still running after @param
+        timeout stay running in the database, so the next start runs them
+        again. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.time(), 0))
+        running = sum(thread.is_alive() for thread in self._threads)
+        self._threads = []
+        if running:
+            print(f"Capture queue {self.path}: {running} jobs still running after {timeout}s, they will run again on the next start")
+        return running == 0
+
+    def counts(self):
+        with self._condition:
+            rows = self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = {state: 0 for state in CaptureQueue.STATES}
+        counts.update({state: count for state, count in rows})
+        return counts
+
+    def jobs(self, states=None):
+        """
+        Return the jobs in @param states, all by default, without their payload.
+        """
+        states = states or CaptureQueue.STATES
+        with self._condition:
+            rows = self._connection().execute(
+                f"""SELECT id, source, state, attempts, next_attempt, created, updated, error FROM jobs
+                    WHERE state IN ({','.join('?' * len(states))}) ORDER BY id""", list(states)).fetchall()
+        return [dict(row) for row in rows]
+
+    def retry_failed(self, ids=None):
+        """
+        Queue the failed jobs with @param ids, all by default, again. Returns
+        the number of jobs queued.
+        """
+        now = time.time()
+        with self._condition:
+            conn = self._connection()
+            with conn:
+                if ids:
+                    count = conn.execute(f"""UPDATE jobs SET state = 'pending', attempts = 0, next_attempt = ?
+                                             WHERE state = 'failed' AND id IN ({','.join('?' * len(ids))})""", [now] + list(ids)).rowcount
+                else:
+                    count = conn.execute("UPDATE jobs SET state = 'pending', attempts = 0, next_attempt = ? WHERE state = 'failed'", (now,)).rowcount
+            self._condition.notify_all()
+        return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the pending and failed capture jobs of MCPEvents")
+    parser.add_argument("path", help="Capture jobs database (default is " + CaptureQueue.path + ")", nargs='?', default=CaptureQueue.path)
+    parser.add_argument("--state", help="Only list the jobs in this state", choices=CaptureQueue.STATES)
+    parser.add_argument("--retry", help="Queue the failed jobs with these ids again, all of them when no id is given", nargs='*', type=int)
+    args = parser.parse_args()
+    if not os.path.isfile(args.path):
+        parser.error(f"{args.path} not found")
+    queue = CaptureQueue({"path": args.path}, None)
+    if args.retry is not None:
+        print(f"Queued {queue.retry_failed(args.retry)} failed jobs again")
+    for job in queue.jobs([args.state] if args.state else None):
+        next_attempt = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['next_attempt']))
+        print(f"{job['id']:>6} {job['source']:<20} {job['state']:<8} attempts {job['attempts']} next {next_attempt} {job['error'] or ''}")
+    print(", ".join(f"{count} {state}" for state, count in queue.counts().items()))
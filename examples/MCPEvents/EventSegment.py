@@ -8,6 +8,12 @@ class EventSegment:
         self.end_ts = start_ts
         self.videos = []
 
+    @staticmethod
+    def from_dict(data):
+        event_segment = EventSegment(data['start_ts'])
+        event_segment.__dict__.update(data)
+        return event_segment
+
     def add_event(self, event):
         self.events_list.append(event)
 
@@ -6,7 +6,6 @@ import json
 from EventSegment import EventSegment
 from ROIFilter import ROIFilter
 import argparse
-import numpy as np
 import m3u8
 
 class MCPEventAnnotator:
@@ -20,17 +19,20 @@ class MCPEventAnnotator:
                         sensors_json = None,
                         annotated_subdir=None,
                         timestamp_display=DEFAULT_DISPLAY_TIMESTAMPS,
-                        postprocess_sensors=DEFAULT_POSTPROCESS_SENSORS):
+                        postprocess_sensors=DEFAULT_POSTPROCESS_SENSORS,
+                        roi_filter=None):
         self.capture_dir = capture_dir
         if self.capture_dir is None:
             self.capture_dir = MCPEventAnnotator.DEFAULT_CAPTURE_DIR
         self.annotated_subdir = annotated_subdir
         if self.annotated_subdir is None:
             self.annotated_subdir = MCPEventAnnotator.DEFAULT_ANNOTATED_VIDEO_WRITE_SUBDIR
-        self.roi_filter = None
+        # A ROIFilter may be shared with the caller, to compile sensors.json once
+        self.roi_filter = roi_filter
         self.sensor_annotations = {}
-        if sensors_json:
+        if self.roi_filter is None and sensors_json:
             self.roi_filter = ROIFilter(sensors_json)
+        if self.roi_filter:
             self.init_sensors()
         self.timestamp_display = timestamp_display
 
@@ -159,22 +161,12 @@ class MCPEventAnnotator:
                         1.15 , (255, 255, 0), 2, cv2.LINE_AA, False)
 
     def annotate_frame_with_sensors(self, frame):
-        poly_points = {}
         if self.roi_filter:
-            for region_id in self.roi_filter.regions:
-                region = self.roi_filter.regions[region_id]
-                xx, yy = region.polygon.exterior.coords.xy
-                height = frame.shape[0]
-                width = frame.shape[1]
-                xx_scaled = [ int(x * width) for x in xx ]
-                yy_scaled = [ int(y * height) for y in yy ]
-                poly_points[region.name] = {
-                    "array" : np.array(list(zip(xx_scaled, yy_scaled))),
-                    "color" : (0, 255, 0) if self.sensor_annotations[region_id]['objects_in_region'] else (255, 0, 0)
-                }
-            for name in poly_points.keys():
-                cv2.polylines(frame, [poly_points[name]['array']], True,
-                                     poly_points[name]['color'], 2)
+            height = frame.shape[0]
+            width = frame.shape[1]
+            for region_id, points in self.roi_filter.get_sensor_polylines(width, height).items():
+                color = (0, 255, 0) if self.sensor_annotations.get(region_id, {}).get('objects_in_region') else (255, 0, 0)
+                cv2.polylines(frame, [points], True, color, 2)
 
     def get_overall_fps(self, vidfile):
         vid_capture = cv2.VideoCapture(str(vidfile))
@@ -229,6 +221,9 @@ class MCPEventAnnotator:
         return vidfiles, start_timestamps
 
     def create_annotation(self, jsonfile, vidfile):
+        # Pick up the edits of sensors.json of long running processes
+        if self.roi_filter and self.roi_filter.reload():
+            self.init_sensors()
         annotated_subdir = Path(vidfile).parent / Path(self.annotated_subdir)
         annotated_subdir.mkdir(parents=True, exist_ok=True)
         annotated_vid = Path(annotated_subdir)/Path(jsonfile).stem
@@ -2,16 +2,48 @@ import signal
 import sys
 import argparse
 import os
+import zlib
+import traceback
+import multiprocessing
+from threading import Lock
 from lib.AMQPListener import AMQPListener
+from lib.Replay import ReplayListener
 from lib.MCP import MCPClient
 from EventSegment import EventSegment
+from CaptureQueue import CaptureQueue, JobFailed
 from ROIFilter import ROIFilter
 from MCPEventAnnotator import MCPEventAnnotator
 import datetime
 from pathlib import Path
-import m3u8
 from cachetools import TTLCache
 
+def run_shard(args, index, queue):
+    """
+    Worker process of shard @param index, processing the messages of its
+    sources from @param queue until it gets None, or "drain" to also wait
+    for its capture jobs.
+    """
+    # The parent process handles ctrl->c and stops the shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    events = MCPEvents(args)
+    events.capture_queue.start()
+    print(f"Shard {index} started")
+    drain = False
+    try:
+        while True:
+            data = queue.get()
+            if data is None or data == "drain":
+                drain = data == "drain"
+                break
+            try:
+                events.json_callback(data)
+            except Exception as e:
+                print(f"Caught exception {e} in shard {index}")
+                traceback.print_exc()
+    finally:
+        events.stop(drain)
+    print(f"Shard {index} stopped")
+
 class MCPEvents:
     def get_args(self, args):
         amqp_conf, mcp_conf = {}, {}
@@ -29,7 +61,12 @@ class MCPEvents:
 
     def __init__(self, args):
         self.listener = None
+        self.args = args
         self.amqp_conf, mcp_conf = self.get_args(args)
+        # Replay recorded anypipe messages instead of listening to AMQP
+        self.replay_conf = None
+        if args.replay:
+            self.replay_conf = {"files": args.replay, "speed": args.replay_speed}
 
         self.mcp_client = MCPClient(mcp_conf)
         self.host = args.host
@@ -51,7 +88,28 @@ class MCPEvents:
         # Consider events ended when they reach this maximum length
         # in milliseconds. Only used when use_events is not specified.
         self.group_events_max_length = 60*1000
+        # Number of video segments downloaded in parallel for each event segment
+        self.download_concurrency = args.download_concurrency
+        # Event segments are captured and annotated by the jobs of this queue,
+        # so the listener never waits for the video downloads or encodes.
+        # The jobs are kept in capture_jobs and resumed after a restart
+        self.capture_jobs = args.capture_jobs or str(self.path_prefix / "capture_jobs.sqlite")
+        self.capture_queue = CaptureQueue({"path": self.capture_jobs, "workers": args.capture_workers,
+                                           "per_source": args.capture_per_source, "max_attempts": args.capture_attempts},
+                                          self.run_capture_job)
+        # The annotator keeps the state of the video it annotates, one at a time
+        self.annotation_lock = Lock()
+        # Worker processes, each one processing the messages of the sources hashed to it
+        self.shards = args.shards
+        # Seconds the shards get to finish their queued messages when stopped, before being terminated
+        self.shard_stop_timeout = 30
+        # Seconds the running capture jobs get to finish when stopped, shorter than the
+        # shard_stop_timeout. The jobs interrupted run again on the next start
+        self.capture_stop_timeout = 20
+        self.shard_queues = []
+        self.shard_processes = []
         self.roi_filter = None
+        self.annotator = None
         self.use_events = False
         if args.use_events:
             print("Generating events based on event generator output")
@@ -66,10 +124,12 @@ class MCPEvents:
                 print("Generating events based on all events")
         if args.annotate:
             self.annotator = MCPEventAnnotator(capture_dir = capture_dir,
-                                               sensors_json = args.sensors_json)
+                                               sensors_json = args.sensors_json,
+                                               roi_filter = self.roi_filter)
 
     def signal_handler(self, sig, frame):
-        print('Exit due to ctrl->c')
+        print('Exit due to ctrl->c' if sig == signal.SIGINT else f'Exit due to signal {sig}')
+        # Unwinds the listener, main() then stops the shards and the capture jobs
         sys.exit(0)
 
     @staticmethod
@@ -87,7 +147,7 @@ class MCPEvents:
         self.completed_event_seg[source].append(event_segment)
         print("Event segment completed, waiting for video close")
 
-    def event_segment_complete(self, source, event_segment):
+    def event_segment_complete(self, source, event_segment, videos):
         time_str = self.frame_timestamp_to_timestr(event_segment.start_ts)
         duration_s = (event_segment.end_ts-event_segment.start_ts)//1000
         dirpath = self.path_prefix / Path(self.frame_timestamp_to_dirstr(event_segment.start_ts))
@@ -95,19 +155,13 @@ class MCPEvents:
         dirpath_json.mkdir(parents=True, exist_ok=True)
         filename_base=f"{source}_{time_str}_{duration_s}s_{len(event_segment.events_list)}_events"
         print(f"Event segment complete, capturing video at {dirpath}/{filename_base}")
-        m3u8_content = self.mcp_client.get_m3u8(source, int(event_segment.start_ts/1000),int(event_segment.end_ts/1000))
-        # Remove all #EXT-UNIX-TIMESTAMP-MS lines from the m3u8 file
-        # m3u8 library doesn't support this tag
-        m3u8_content = '\n'.join([line for line in m3u8_content.split('\n') if not line.startswith("#EXT-UNIX-TIMESTAMP-MS")])
-        playlist = m3u8.loads(m3u8_content)
-        for segment in playlist.segments:
-            filepath_ts = dirpath / Path(segment.uri)
-            filepath_ts.parent.mkdir(parents=True, exist_ok=True)
-            video_name = filepath_ts.relative_to(filepath_ts.parent.parent)
-            print(f"Downloading {video_name}")
-            self.mcp_client.download_video(source, video_name, filepath_ts)
-            if source in self.video_cache and str(video_name) in self.video_cache[source]:
-                event_segment.videos.append(self.video_cache[source][str(video_name)])
+        # Fetch the playlist and download all of its segments in parallel
+        download = self.mcp_client.download_range(source, int(event_segment.start_ts/1000), int(event_segment.end_ts/1000),
+                                                  dirpath, concurrency=self.download_concurrency)
+        m3u8_content = download["m3u8"]
+        for video_name in download["segments"]:
+            if str(video_name) in videos:
+                event_segment.videos.append(videos[str(video_name)])
             else:
                 print(f"Could not find {video_name} in video cache for {source}")
 
@@ -120,29 +174,44 @@ class MCPEvents:
         print(f"Writing {json_file}")
         event_segment.write_json(json_file)
         if self.annotator:
-            self.annotator.create_annotation(json_file, vidfile)
+            # Annotated by its own job, so a failed annotation doesn't download the video again
+            self.capture_queue.submit(source, {"type": "annotate", "json_file": str(json_file), "vidfile": str(vidfile)})
         print(f"Event segment complete")
 
+    def run_capture_job(self, source, job):
+        if job["type"] == "capture":
+            self.event_segment_complete(source, EventSegment.from_dict(job["event_segment"]), job["videos"])
+        elif job["type"] == "annotate":
+            if self.annotator is None:
+                raise JobFailed(f"Can't annotate {job['vidfile']}, MCPEvents is running without --annotate")
+            with self.annotation_lock:
+                self.annotator.create_annotation(Path(job["json_file"]), Path(job["vidfile"]))
+
     # This method is called when a media event is received from the MCP
     def handle_media_event_callback(self, media_event, sourceId):
         # Get the type and message of the media event
         type = media_event.get("type", "unknown")
-        # msg = media_event.get("msg", "unknown")
+        msg = media_event.get("msg", "unknown")
         # If the media event is a video_file_closed event, add it to the current event segment
         # for the source ID, or to the completed event segments if it's already completed
         if type == "video_file_closed":
             if not sourceId in self.video_cache:
                 self.video_cache[sourceId] = TTLCache(maxsize=100, ttl=60*2)
             self.video_cache[sourceId][msg] = media_event
-            completed_event_segments = self.completed_event_seg.get(sourceId, [])
+            # The segments are always completed, even if we couldn't download vids.
+            # The capture jobs get a copy of the video cache
+            completed_event_segments = self.completed_event_seg.pop(sourceId, [])
+            videos = dict(self.video_cache[sourceId])
             for event_seg in completed_event_segments:
-                try:
-                    self.event_segment_complete(sourceId, event_seg)
-                finally:
-                    # Always complete the event segment, even if we couldn't download vids
-                    self.completed_event_seg[sourceId].remove(event_seg)
-
+                self.capture_queue.submit(sourceId, {"type": "capture", "event_segment": vars(event_seg), "videos": videos})
 
+    def shard_callback(self, data):
+        """
+        Queue @param data to the shard of its sourceId, the same one for all
+        messages of a source so each shard owns the state of its sources.
+        """
+        source_id = str(data.get("sourceId", "unknown"))
+        self.shard_queues[zlib.crc32(source_id.encode()) % self.shards].put(data)
 
     def json_callback(self, data):
         if 'frameTimestamp' not in data or 'sourceId' not in data:
@@ -209,22 +278,78 @@ class MCPEvents:
                     current_event_seg.end_ts = frameTimestamp
     
 
+    def start_shards(self):
+        base, ext = os.path.splitext(self.capture_jobs)
+        for index in range(self.shards):
+            # Each shard has its own capture jobs
+            shard_args = argparse.Namespace(**{**vars(self.args), "shards": 0, "capture_jobs": f"{base}-{index}{ext}"})
+            queue = multiprocessing.Queue(maxsize=1000)
+            # Daemon so an unexpected exit of this process never waits on the shards
+            process = multiprocessing.Process(target=run_shard, args=(shard_args, index, queue),
+                                              name=f"mcpevents-shard-{index}", daemon=True)
+            process.start()
+            self.shard_queues.append(queue)
+            self.shard_processes.append(process)
+
     def start(self):
         self.path_prefix.mkdir(parents=True, exist_ok=True)
-        self.listener = AMQPListener(self.amqp_conf)
-        self.listener.set_callback(self.json_callback)
+        if self.replay_conf:
+            self.listener = ReplayListener(self.replay_conf)
+        else:
+            self.listener = AMQPListener(self.amqp_conf)
+        if self.shards > 0:
+            self.start_shards()
+            self.listener.set_callback(self.shard_callback)
+        else:
+            self.capture_queue.start()
+            self.listener.set_callback(self.json_callback)
         self.listener.start()
 
 
-    def stop(self):
+    def stop(self, drain=False):
+        """
+        Stop the listener, then wait for the shards to process their queued
+        messages and for the capture jobs in progress. The pending jobs are
+        resumed on the next start, unless @param drain waits for them too.
+        """
         if self.listener:
             self.listener.stop()
+            self.listener = None
+        # Draining waits for all the queued messages, stopping only for the shard_stop_timeout
+        timeout = None if drain else self.shard_stop_timeout
+        for queue, process in zip(self.shard_queues, self.shard_processes):
+            try:
+                queue.put("drain" if drain else None, timeout=timeout)
+            except Exception:
+                print(f"Shard {process.name} queue is full, terminating it")
+                process.terminate()
+        for queue, process in zip(self.shard_queues, self.shard_processes):
+            process.join(timeout)
+            if process.is_alive():
+                print(f"Shard {process.name} didn't stop within {timeout}s, terminating it")
+                process.terminate()
+                process.join()
+            # Don't wait at exit to write messages the shard will never read
+            queue.cancel_join_thread()
+        self.shard_queues, self.shard_processes = [], []
+        if drain:
+            self.capture_queue.join()
+        self.capture_queue.stop(self.capture_stop_timeout)
 
     def main(self):
-        self.start()
+        # Installed first, the AMQP listener consumes on this thread until stopped
         signal.signal(signal.SIGINT, self.signal_handler)
-        while True:
-            signal.pause()
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        drain = False
+        try:
+            self.start()
+            if self.replay_conf:
+                drain = True
+                return
+            while True:
+                signal.pause()
+        finally:
+            self.stop(drain)
 
 
 if __name__ == "__main__":
@@ -236,6 +361,14 @@ if __name__ == "__main__":
     parser.add_argument("--mcp_password", help="Password for MCP", default="root")
     parser.add_argument("--use_events", help="Use only event generator events to select recording intervals", action='store_true')
     parser.add_argument("--annotate", help="Create annotated video after event completion", action='store_true')
+    parser.add_argument("--replay", help="Replay these recorded anypipe JSON lines files instead of listening to AMQP", nargs='+')
+    parser.add_argument("--replay_speed", help="Replay speed, 1 is the original rate and 0 as fast as possible (default is 1)", default=1.0, type=float)
+    parser.add_argument("--download_concurrency", help="Number of video segments to download in parallel (default is 4)", default=4, type=int)
+    parser.add_argument("--shards", help="Number of worker processes the sources are hashed to, 0 processes all messages in this process (default is 0)", default=0, type=int)
+    parser.add_argument("--capture_workers", help="Number of capture and annotation jobs run in parallel by each process (default is 2)", default=2, type=int)
+    parser.add_argument("--capture_per_source", help="Number of capture and annotation jobs of the same source run in parallel (default is 1)", default=1, type=int)
+    parser.add_argument("--capture_attempts", help="Attempts of a capture or annotation job before it's marked failed (default is 5)", default=5, type=int)
+    parser.add_argument("--capture_jobs", help="Database of the capture jobs (default is capture_jobs.sqlite in the capture directory)")
     args = parser.parse_args()
     events = MCPEvents(args)
     events.main()
@@ -1,5 +1,11 @@
 from shapely import geometry
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+import shapely
+import numpy as np
 import json
+import os
+import time
 
 class ROIFilter:
     class ROIRegion:
@@ -26,38 +32,185 @@ class ROIFilter:
         except Exception as e:
             print("ROI Filter point conversion error: ", e)
 
+    class SensorModel:
+        """
+        sensors.json compiled for the lookups: the regions with their
+        normalized polygons, prepared and partitioned by the (metaclass, class)
+        they apply to, and the pixel polylines of the regions for each frame
+        size. A model is never changed once loaded apart from these caches,
+        a reload builds a new one.
+        """
+        def __init__(self, file, tree_min_regions):
+            self.file = file
+            self.mtime = os.path.getmtime(file)
+            self.tree_min_regions = tree_min_regions
+            self.regions = {}
+            with open(file,'r') as f:
+                self.sensors = json.loads(f.read())
+                for data in self.sensors['presenceSensors']:
+                    polygon = ROIFilter.convert_points_to_polygon(data['polygon'])
+                    name = data['name']
+                    classes = data['classes']
+                    id = data['id']
+                    self.regions[id] = ROIFilter.ROIRegion(polygon, name, classes, id)
+            self.region_list = [region for region in self.regions.values() if region.polygon is not None]
+            self.region_names = [region.name for region in self.region_list]
+            self.polygons = np.array([region.polygon for region in self.region_list], dtype=object)
+            # Shapely 1.8 has no vectorized STRtree queries, use prepared geometries
+            if hasattr(shapely, 'contains_xy'):
+                shapely.prepare(self.polygons)
+                self.prepared = None
+            else:
+                self.prepared = [prep(polygon) for polygon in self.polygons]
+            # (metaclass, class) -> (region indexes, STRtree of their polygons or None)
+            self._partitions = {}
+            # (width, height) -> {region id: int32 array of the polygon points in pixels}
+            self._polylines = {}
+
+        def partition(self, key):
+            """
+            Return the (region indexes, STRtree or None) of the regions applying
+            to the (metaclass, class) @param key. Partitions of tree_min_regions
+            or more regions get an STRtree, smaller ones are tested all at once
+            with contains_xy.
+            """
+            partition = self._partitions.get(key)
+            if partition is None:
+                metaclass, obj_class = key
+                indexes = np.array([i for i, region in enumerate(self.region_list)
+                                    if metaclass in region.classes or obj_class in region.classes], dtype=np.intp)
+                tree = None
+                if self.prepared is None and len(indexes) >= self.tree_min_regions:
+                    tree = STRtree(self.polygons[indexes])
+                partition = (indexes, tree)
+                self._partitions[key] = partition
+            return partition
+
+        def polylines(self, width, height):
+            """
+            Return a dict of region id to the points of its polygon in pixels
+            of a @param width x @param height frame, as cv2.polylines takes them.
+            """
+            polylines = self._polylines.get((width, height))
+            if polylines is None:
+                polylines = {}
+                for region in self.region_list:
+                    xx, yy = region.polygon.exterior.coords.xy
+                    polylines[region.id] = np.array([[int(x * width), int(y * height)] for x, y in zip(xx, yy)],
+                                                    dtype=np.int32)
+                self._polylines[(width, height)] = polylines
+            return polylines
+
+    # Seconds between the checks of the sensors file for changes, zero disables
+    check_interval = 5
+    # Partitions with fewer regions test all of them at once rather than
+    # querying an STRtree, which only pays off with many regions
+    tree_min_regions = 16
+
     def __init__(self, file):
-        self.regions = {}
-        with open(file,'r') as f:
-            self.sensors = json.loads(f.read())
-            for data in self.sensors['presenceSensors']:
-                polygon = self.convert_points_to_polygon(data['polygon'])
-                name = data['name']
-                classes = data['classes']
-                id = data['id']
-                self.regions[id] = ROIFilter.ROIRegion(polygon, name, classes, id)
+        self.file = file
+        self._checked = time.monotonic()
+        self.model = ROIFilter.SensorModel(file, self.tree_min_regions)
 
-    def get_object_region_map(self, data):
-        region_map = {}
+    @property
+    def regions(self):
+        return self.model.regions
+
+    @property
+    def sensors(self):
+        return self.model.sensors
+
+    def reload(self):
+        """
+        Compile the sensors file again when it changed since it was loaded,
+        checking it at most every check_interval seconds. The new model
+        replaces the previous one at once, so callers holding the previous one
+        finish with it. Returns True when it was reloaded.
+        """
+        now = time.monotonic()
+        if self.check_interval <= 0 or now - self._checked < self.check_interval:
+            return False
+        self._checked = now
+        try:
+            if os.path.getmtime(self.file) == self.model.mtime:
+                return False
+            self.model = ROIFilter.SensorModel(self.file, self.tree_min_regions)
+        except Exception as e:
+            print(f"ROI Filter failed to reload {self.file}, keeping the previous regions: {e}")
+            return False
+        print(f"ROI Filter reloaded {len(self.model.regions)} regions from {self.file}")
+        return True
+
+    def get_object_points(self, data):
+        """
+        Return (ids, keys, points) for the objects of @param data with a box:
+        their ids, their (metaclass, class) and a (n, 2) array of their anchor
+        points, the bottom right corner of the box normalized to the frame
+        dimensions.
+        """
+        ids, keys, points = [], [], []
         metaclasses = data['metaClasses']
         frame_dimensions = data['frameDimensions']
-        for metaclass in metaclasses.keys():
-            for obj_id in metaclasses[metaclass].keys():
-                obj_dict = metaclasses[metaclass][obj_id]
-                obj_class = obj_dict['class']
-                if 'box' in obj_dict:
-                    # Generate a point which is the bottom right corner of the bounding box
-                    point = geometry.Point((obj_dict['box']['x']+obj_dict['box']['width'])/frame_dimensions['w'],
-                                            (obj_dict['box']['y']+obj_dict['box']['height'])/frame_dimensions['h'])
-                    for region_id in self.regions:
-                        region = self.regions[region_id]
-                        if metaclass in region.classes or obj_class in region.classes:
-                            if region.polygon.contains(point):
-                                if not region.name in region_map:
-                                    region_map[obj_id] = []
-                                region_map[obj_id].append(region.name)
+        w, h = frame_dimensions['w'], frame_dimensions['h']
+        for metaclass, objects in metaclasses.items():
+            for obj_id, obj_dict in objects.items():
+                box = obj_dict.get('box')
+                if box is not None:
+                    ids.append(obj_id)
+                    keys.append((metaclass, obj_dict['class']))
+                    points.append(((box['x'] + box['width']) / w, (box['y'] + box['height']) / h))
+        return ids, keys, np.array(points, dtype=float).reshape(-1, 2)
+
+    @staticmethod
+    def _contains(model, indexes, tree, points):
+        """
+        Return the (point, region) index pairs of the regions of the partition
+        @param indexes containing each of @param points, sorted by point.
+        """
+        if tree is not None:
+            point_idx, tree_idx = tree.query(shapely.points(points), predicate='within')
+            return point_idx, indexes[tree_idx]
+        if model.prepared is None:
+            point_idx, region_idx = np.nonzero(shapely.contains_xy(
+                model.polygons[indexes][np.newaxis, :], points[:, 0:1], points[:, 1:2]))
+            return point_idx, indexes[region_idx]
+        pairs = [(i, j) for i, (x, y) in enumerate(points) for j in indexes
+                 if model.prepared[j].contains(geometry.Point(x, y))]
+        return [i for i, _ in pairs], [j for _, j in pairs]
+
+    def get_object_region_map(self, data):
+        """
+        Return a dict of object id to the names of the regions containing it,
+        for the regions applying to its metaclass or class.
+        """
+        self.reload()
+        model = self.model
+        region_map = {}
+        if not model.region_list:
+            return region_map
+        ids, keys, points = self.get_object_points(data)
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(key, []).append(i)
+        found = {}
+        for key, group in groups.items():
+            indexes, tree = model.partition(key)
+            if not len(indexes):
+                continue
+            group = np.array(group, dtype=np.intp)
+            for i, j in zip(*self._contains(model, indexes, tree, points[group])):
+                found.setdefault(int(group[i]), []).append(int(j))
+        # Objects and their regions in the order of the message and of sensors.json
+        for i in sorted(found):
+            region_map[ids[i]] = [model.region_names[j] for j in sorted(found[i])]
         return region_map
 
+    def get_sensor_polylines(self, width, height):
+        """
+        Return a dict of region id to its polygon in pixels of a @param width
+        x @param height frame, computed once for each frame size.
+        """
+        return self.model.polylines(width, height)
 
     def objects_in_roi(self, data):
         return len(self.get_object_region_map(data).keys()) > 0
@@ -66,4 +219,3 @@ class ROIFilter:
         return self.regions.get(id, None)
     def get_regions(self):
         return self.regions.values()
-
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import os
+import json
+import random
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "docs", "schemas", "anypipe", "anypipe.json")
+
+class AnypipeGenerator:
+    """
+    Generates synthetic anypipe frames following docs/schemas/anypipe/anypipe.json.
+    Each source has a set of tracked objects, which keep their ids between
+    frames while their boxes move, as the pipelines output them.
+    """
+    sources = 4
+    fps = 10
+    width = 1920
+    height = 1080
+    # Objects of each frame
+    vehicles = 5
+    # Fraction of the vehicles with a linked license plate
+    plates_ratio = 0.5
+    people = 2
+    # Presence sensor events of each frame
+    sensor_events = 2
+    # Media events of each frame, of the image type
+    media_events = 1
+    # Frames an object stays tracked before it's replaced by a new one
+    track_length = 50
+    start_ts = 1698078993326
+    seed = 0
+
+    MAKES = ["nissan,murano,2009 2014", "toyota,camry,2018 2023", "ford,f150,2015 2020", "honda,civic,2016 2021"]
+    COLORS = ["silver/grey", "white", "black", "red", "blue"]
+    REGIONS = ["Florida", "California", "Texas", "New York"]
+
+    def __init__(self, conf=None, schema=SCHEMA):
+        conf = conf or {}
+        for name in ["sources", "fps", "width", "height", "vehicles", "people", "sensor_events",
+                     "media_events", "track_length", "start_ts", "seed"]:
+            setattr(self, name, int(conf.get(name, getattr(AnypipeGenerator, name))))
+        self.plates_ratio = float(conf.get("plates_ratio", AnypipeGenerator.plates_ratio))
+        with open(schema) as f:
+            self.schema = json.load(f)
+        self.random = random.Random(self.seed)
+        self.frame = 0
+
+    def _required(self, definition):
+        return self.schema["definitions"][definition].get("required", [])
+
+    def _score(self):
+        return round(self.random.uniform(0.5, 1.0), 2)
+
+    def _attribute(self, value):
+        return {"value": value, "attributeScore": self._score(), "detectionScore": self._score(), "updated": True}
+
+    def _box(self, index, count, track_frame, w, h):
+        # Objects spread over the frame, moving right with each frame
+        x = (index * self.width // max(count, 1) + track_frame * 4) % max(self.width - w, 1)
+        y = (self.height // 3 + (index * 97) % (self.height // 2)) % max(self.height - h, 1)
+        return {"x": x, "y": y, "width": w, "height": h}
+
+    def _object(self, cls, box, timestamp, attributes=None, links=None):
+        obj = {
+            "class": cls,
+            "box": box,
+            "detectionScore": self._score(),
+            "bestDetectionTimestamp": timestamp,
+            "firstFrameTimestamp": timestamp,
+            "updated": True,
+            "attributes": attributes or {},
+        }
+        if links:
+            obj["links"] = links
+        return obj
+
+    def metaclasses(self, source_id, timestamp):
+        track, track_frame = divmod(self.frame, self.track_length)
+        vehicles, plates, people = {}, {}, {}
+        for i in range(self.vehicles):
+            vehicle_id = f"{source_id}-car-{i}-{track}"
+            box = self._box(i, self.vehicles, track_frame, 300, 200)
+            links = []
+            if i < round(self.vehicles * self.plates_ratio):
+                plate_id = f"{source_id}-lp-{i}-{track}"
+                plates[plate_id] = self._object(
+                    "licensePlate",
+                    {"x": box["x"] + 100, "y": box["y"] + 140, "width": 73, "height": 44},
+                    timestamp,
+                    {"lpString": self._attribute(f"LP{i:02d}{track % 1000:03d}"),
+                     "lpRegion": self._attribute(self.REGIONS[i % len(self.REGIONS)])},
+                    [{"metaClass": "vehicles", "id": vehicle_id}])
+                links.append({"metaClass": "licensePlates", "id": plate_id})
+            vehicles[vehicle_id] = self._object(
+                "car", box, timestamp,
+                {"vehicleType": self._attribute(self.MAKES[i % len(self.MAKES)]),
+                 "color": self._attribute(self.COLORS[i % len(self.COLORS)])},
+                links)
+        for i in range(self.people):
+            people[f"{source_id}-person-{i}-{track}"] = self._object(
+                "person", self._box(i, self.people, track_frame, 60, 160), timestamp)
+        metaclasses = {"vehicles": vehicles, "people": people}
+        if plates:
+            metaclasses["licensePlates"] = plates
+        return metaclasses
+
+    def sensor_events_for(self, source_id, timestamp, metaclasses):
+        events = {}
+        objects = [(metaclass, id) for metaclass in metaclasses for id in metaclasses[metaclass]]
+        for i in range(self.sensor_events):
+            linked = objects[i::max(self.sensor_events, 1)]
+            started = timestamp - (self.frame % self.track_length) * 1000 // self.fps
+            event = {
+                "eventId": f"{source_id}-event-{i}-{self.frame // self.track_length}",
+                "objectsInRegionCount": len(linked),
+                "objectsCountbyMetaClass": {},
+                "objectsCountbyClass": {},
+                "startedAt": started,
+                "updateCount": self.frame % self.track_length + 1,
+                "links": [{"metaClass": metaclass, "id": id, "startedAt": started, "state": "in"} for metaclass, id in linked],
+            }
+            for metaclass, id in linked:
+                cls = metaclasses[metaclass][id]["class"]
+                event["objectsCountbyMetaClass"][metaclass] = event["objectsCountbyMetaClass"].get(metaclass, 0) + 1
+                event["objectsCountbyClass"][cls] = event["objectsCountbyClass"].get(cls, 0) + 1
+            # The last frame of each track ends its events
+            if self.frame % self.track_length == self.track_length - 1:
+                event["endedAt"] = timestamp
+            events[f"{source_id}-sensor-{i}"] = [event]
+        return {"presenceSensor": events} if events else {}
+
+    def media_events_for(self, source_id, timestamp):
+        return [{"type": "image", "msg": f"{source_id}-{timestamp}-{i}.jpg", "format": "jpeg",
+                 "startTs": timestamp, "endTs": timestamp} for i in range(self.media_events)]
+
+    def next_frames(self):
+        """
+        Return the frames of all sources for the next frame time.
+        """
+        timestamp = self.start_ts + self.frame * 1000 // self.fps
+        frames = []
+        for s in range(self.sources):
+            source_id = f"source-{s}"
+            metaclasses = self.metaclasses(source_id, timestamp)
+            frame = {
+                "apiVersion": {"major": 1, "minor": 1},
+                "sourceId": source_id,
+                "frameId": f"{source_id}-frame-{self.frame}",
+                "frameDimensions": {"w": self.width, "h": self.height},
+                "analyticsTimestamp": timestamp + 20,
+                "frameTimestamp": timestamp,
+                "metaClasses": metaclasses,
+            }
+            sensor_events = self.sensor_events_for(source_id, timestamp, metaclasses)
+            if sensor_events:
+                frame["sensorEvents"] = sensor_events
+            media_events = self.media_events_for(source_id, timestamp)
+            if media_events:
+                frame["mediaEvents"] = media_events
+            frames.append(frame)
+        self.frame += 1
+        return frames
+
+    def frames(self, count):
+        """
+        Return @param count frames, from all sources in turn.
+        """
+        frames = []
+        while len(frames) < count:
+            frames += self.next_frames()
+        return frames[:count]
+
+    def validate(self, frame):
+        """
+        Check @param frame against the schema, fully when the jsonschema package
+        is installed, otherwise only the fields required by the schema.
+        """
+        try:
+            import jsonschema
+        except ImportError:
+            jsonschema = None
+        if jsonschema is not None:
+            jsonschema.validate(frame, self.schema)
+            return
+        missing = [field for field in self.schema["required"] if field not in frame]
+        for sensors in frame.get("sensorEvents", {}).values():
+            for events in sensors.values():
+                for event in events:
+                    missing += [f"sensorEvents.{field}" for field in self._required("presenceSensor") if field not in event]
+        for event in frame.get("mediaEvents", []):
+            missing += [f"mediaEvents.{field}" for field in self.schema["definitions"]["mediaEvents"]["items"]["required"]
+                        if field not in event]
+        if missing:
+            raise Exception(f"Frame {frame.get('frameId')} is missing {missing}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write synthetic anypipe frames as JSON lines")
+    parser.add_argument("output", help="JSON lines file to write")
+    parser.add_argument("--count", help="Number of frames", default=1000, type=int)
+    parser.add_argument("--sources", help="Number of sources", default=AnypipeGenerator.sources, type=int)
+    parser.add_argument("--vehicles", help="Vehicles in each frame", default=AnypipeGenerator.vehicles, type=int)
+    parser.add_argument("--people", help="People in each frame", default=AnypipeGenerator.people, type=int)
+    parser.add_argument("--sensor_events", help="Sensor events in each frame", default=AnypipeGenerator.sensor_events, type=int)
+    parser.add_argument("--media_events", help="Media events in each frame", default=AnypipeGenerator.media_events, type=int)
+    args = parser.parse_args()
+    generator = AnypipeGenerator(vars(args))
+    with open(args.output, "w") as f:
+        for frame in generator.frames(args.count):
+            f.write(json.dumps(frame) + "\n")
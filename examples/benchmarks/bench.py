@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the anypipe message consumers, run on synthetic frames of
+anypipe_generator. Each benchmark runs a consumer hot path in isolation and
+reports messages/s, p50/p99 latency and allocations, see README.md.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import importlib.util
+import tracemalloc
+from argparse import Namespace
+from contextlib import redirect_stdout
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES_DIR = os.path.dirname(BENCH_DIR)
+REPO_DIR = os.path.dirname(EXAMPLES_DIR)
+sys.path[:0] = [BENCH_DIR, EXAMPLES_DIR, os.path.join(EXAMPLES_DIR, "MCPEvents")]
+
+from anypipe_generator import AnypipeGenerator
+from lib.Replay import percentiles
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+def load_module(name, path, paths=()):
+    """
+    Import the module at @param path as @param name, with @param paths added
+    to sys.path for its own imports.
+    """
+    sys.path[:0] = list(paths)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write_sensors(path, regions):
+    """
+    Write a sensors.json with @param regions presence sensors in a grid over
+    the frame, alternately for vehicles and people.
+    """
+    sensors = []
+    columns = max(1, int(regions ** 0.5))
+    rows = (regions + columns - 1) // columns
+    for i in range(regions):
+        x0, y0 = (i % columns) / columns, (i // columns) / rows
+        x1, y1 = x0 + 1 / columns, y0 + 1 / rows
+        sensors.append({
+            "id": f"sensor-{i}",
+            "name": f"region-{i}",
+            "classes": ["vehicles"] if i % 2 == 0 else ["person"],
+            "polygon": [{"x": x0, "y": y0}, {"x": x1, "y": y0}, {"x": x1, "y": y1}, {"x": x0, "y": y1}],
+        })
+    with open(path, "w") as f:
+        json.dump({"presenceSensors": sensors}, f)
+    return path
+
+# Each setup returns the function to benchmark, called with one message,
+# and the message as it takes it
+def setup_roi(workdir, args):
+    from ROIFilter import ROIFilter
+    roi_filter = ROIFilter(write_sensors(os.path.join(workdir, "sensors.json"), args.regions))
+    return roi_filter.get_object_region_map, lambda frame: frame
+
+def setup_mcpevents(workdir, args, use_events=False):
+    # examples/MCPEvents is also a package, so the module is loaded from its path
+    module = load_module("mcpevents", os.path.join(EXAMPLES_DIR, "MCPEvents", "MCPEvents.py"))
+    events = module.MCPEvents(Namespace(
+        host="localhost", capture_dir=os.path.join(workdir, "captures"),
+        sensors_json=None if use_events else write_sensors(os.path.join(workdir, "sensors.json"), args.regions),
+        mcp_username="root", mcp_password="root", use_events=use_events, annotate=False,
+        download_concurrency=1, replay=None, replay_speed=1.0, shards=0, capture_workers=1,
+        capture_per_source=1, capture_attempts=1, capture_jobs=None))
+    return events.json_callback, lambda frame: frame
+
+def setup_mcpevents_events(workdir, args):
+    return setup_mcpevents(workdir, args, use_events=True)
+
+def setup_alpr(workdir, args):
+    alpr = os.path.join(REPO_DIR, "deployment-examples", "ALPRDemo")
+    module = load_module("alpr_sio", os.path.join(alpr, "consumer", "SIO.py"), [os.path.join(alpr, "common")])
+    sio = module.SIO(None, {"path": os.path.join(workdir, "lpdb.sqlite")})
+    sio.initDbConnection()
+    return sio.parseSIOMessage, lambda frame: frame
+
+def setup_aggregator(workdir, args):
+    module = load_module("aggregator_extension", os.path.join(
+        REPO_DIR, "deployment-examples", "StandaloneSIOWithExtension", "config", "analytics", "aggregatorExtension.py"))
+    plugin = module.SIOPlugin()
+    ticks = iter(range(1 << 62))
+    # The extension gets the frame as a JSON string from the pipeline
+    return lambda frame: plugin.process(next(ticks), frame, None), json.dumps
+
+BENCHMARKS = {
+    "roi": setup_roi,
+    "mcpevents": setup_mcpevents,
+    "mcpevents_events": setup_mcpevents_events,
+    "alpr": setup_alpr,
+    "aggregator": setup_aggregator,
+}
+
+def calibrate():
+    """
+    Return the iterations per second of a fixed pure Python loop, used to
+    compare results between machines.
+    """
+    best = 0
+    for _ in range(7):
+        t0 = time.perf_counter()
+        d = {}
+        for i in range(200000):
+            d[i % 1000] = d.get(i % 1000, 0) + i
+        best = max(best, 200000 / (time.perf_counter() - t0))
+    return best
+
+def run_benchmark(name, frames, args):
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        call, prepare = BENCHMARKS[name](workdir, args)
+        messages = [prepare(frame) for frame in frames]
+        warmup, messages = messages[:args.warmup], messages[args.warmup:]
+        for message in warmup:
+            call(message)
+        latencies = []
+        start = time.perf_counter()
+        for message in messages:
+            t0 = time.perf_counter_ns()
+            call(message)
+            latencies.append((time.perf_counter_ns() - t0) / 1e6)
+        elapsed = time.perf_counter() - start
+
+    # Allocations are traced on a fresh instance, tracing slows everything down
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        call, prepare = BENCHMARKS[name](workdir, args)
+        messages = [prepare(frame) for frame in frames[:args.alloc_messages]]
+        tracemalloc.start()
+        tracemalloc.clear_traces()
+        before = tracemalloc.get_traced_memory()[0]
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        for message in messages:
+            call(message)
+        current, peak = tracemalloc.get_traced_memory()
+        retained_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename")) - blocks
+        tracemalloc.stop()
+
+    latency = percentiles(latencies, (50, 99))
+    return {
+        "messages": len(latencies),
+        "msgs_per_second": len(latencies) / elapsed if elapsed > 0 else 0,
+        "p50_ms": latency[50],
+        "p99_ms": latency[99],
+        "peak_kib": (peak - before) / 1024,
+        "retained_bytes_per_msg": (current - before) / max(len(messages), 1),
+        "retained_blocks_per_msg": retained_blocks / max(len(messages), 1),
+    }
+
+def compare(results, baseline, max_regression):
+    """
+    Return the regressions of @param results against @param baseline, the
+    throughput being scaled by the calibration of both machines.
+    """
+    regressions = []
+    scale = results["calibration"] / baseline["calibration"] if baseline.get("calibration") else 1
+    for name, result in results["benchmarks"].items():
+        expected = baseline.get("benchmarks", {}).get(name)
+        if not expected:
+            continue
+        minimum = expected["msgs_per_second"] * scale * (1 - max_regression)
+        if result["msgs_per_second"] < minimum:
+            regressions.append(f"{name}: {result['msgs_per_second']:.0f} msgs/s, expected at least {minimum:.0f}")
+    return regressions
+
+def print_results(results):
+    print(f"Calibration: {results['calibration']:.0f} loops/s")
+    print(f"{'benchmark':<18} {'msgs/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>9} {'B/msg':>9} {'blocks/msg':>10}")
+    for name, r in results["benchmarks"].items():
+        print(f"{name:<18} {r['msgs_per_second']:>10.0f} {r['p50_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['peak_kib']:>9.0f} "
+              f"{r['retained_bytes_per_msg']:>9.0f} {r['retained_blocks_per_msg']:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", help=f"Benchmarks to run, all by default: {', '.join(BENCHMARKS)}", nargs="*")
+    parser.add_argument("--messages", help="Messages of each benchmark", default=5000, type=int)
+    parser.add_argument("--warmup", help="Messages run before measuring", default=200, type=int)
+    parser.add_argument("--alloc_messages", help="Messages run with allocation tracing", default=1000, type=int)
+    parser.add_argument("--sources", help="Sources of the frames", default=AnypipeGenerator.sources, type=int)
+    parser.add_argument("--vehicles", help="Vehicles in each frame", default=AnypipeGenerator.vehicles, type=int)
+    parser.add_argument("--plates_ratio", help="Fraction of vehicles with a license plate", default=AnypipeGenerator.plates_ratio, type=float)
+    parser.add_argument("--people", help="People in each frame", default=AnypipeGenerator.people, type=int)
+    parser.add_argument("--sensor_events", help="Sensor events in each frame", default=AnypipeGenerator.sensor_events, type=int)
+    parser.add_argument("--media_events", help="Media events in each frame", default=AnypipeGenerator.media_events, type=int)
+    parser.add_argument("--regions", help="ROI regions of sensors.json", default=4, type=int)
+    parser.add_argument("--validate", help="Validate the generated frames against the schema", action="store_true")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Fail when slower than this baseline file", nargs="?", const=DEFAULT_BASELINE)
+    parser.add_argument("--max_regression", help="Tolerated throughput loss against the baseline (default 0.25)", default=0.25, type=float)
+    parser.add_argument("--update_baseline", help="Write the results to the baseline file", action="store_true")
+    args = parser.parse_args()
+
+    generator = AnypipeGenerator({name: getattr(args, name) for name in
+                                  ["sources", "vehicles", "plates_ratio", "people", "sensor_events", "media_events"]})
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name}, choose from {', '.join(BENCHMARKS)}")
+    # The first frames warm up each benchmark, the allocations are traced on them too
+    frames = generator.frames(args.warmup + args.messages)
+    if args.validate:
+        for frame in frames:
+            generator.validate(frame)
+
+    results = {"calibration": 0, "config": {k: v for k, v in vars(args).items() if k not in
+               ("benchmarks", "output", "baseline", "update_baseline", "max_regression")}, "benchmarks": {}}
+    calibration = calibrate()
+    for name in args.benchmarks or list(BENCHMARKS):
+        results["benchmarks"][name] = run_benchmark(name, frames, args)
+    # The best of before and after the benchmarks, once the CPU is busy
+    results["calibration"] = max(calibration, calibrate())
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    baseline_file = args.baseline or DEFAULT_BASELINE
+    if args.update_baseline:
+        with open(baseline_file, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Updated {baseline_file}")
+    elif args.baseline:
+        with open(baseline_file) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,27 @@
 import pika, json
 import traceback
 import socket
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 class AMQPListener:
     host = 'localhost'
     exchange = 'anypipe'
     routing_key = '#'
     port = 5672
+    # Number of workers running json_callback. Zero runs the callback inline
+    # on the pika I/O thread with auto_ack, as the listener always did.
+    workers = 0
+    # Either "thread" or "process". Process workers require a picklable callback.
+    worker_type = 'thread'
+    # Maximum number of unacked messages delivered by the broker. Defaults to
+    # 4 messages per worker when workers are enabled.
+    prefetch_count = 0
+    # Ack with multiple=True once this many contiguous messages have completed.
+    # One acks every message individually.
+    ack_batch_size = 1
+    # Requeue messages whose callback raised instead of dropping them.
+    requeue_on_error = False
 
     def __init__(self,conf):
         self.queue_name = None
@@ -18,7 +33,25 @@ class AMQPListener:
         self.exchange = conf.get("exchange", AMQPListener.exchange)
         self.routing_key = conf.get("routing_key", AMQPListener.routing_key)
         self.port = conf.get("port", AMQPListener.port)
+        self.workers = int(conf.get("workers", AMQPListener.workers))
+        self.worker_type = conf.get("worker_type", AMQPListener.worker_type)
+        self.prefetch_count = int(conf.get("prefetch_count", AMQPListener.prefetch_count))
+        if self.workers > 0 and self.prefetch_count <= 0:
+            self.prefetch_count = self.workers * 4
+        self.ack_batch_size = max(1, int(conf.get("ack_batch_size", AMQPListener.ack_batch_size)))
+        # A batch larger than the prefetch window would never fill, the broker
+        # stops delivering while the messages wait to be acked
+        if self.prefetch_count > 0 and self.ack_batch_size > self.prefetch_count:
+            print(f"ack_batch_size {self.ack_batch_size} exceeds prefetch_count {self.prefetch_count}, using {self.prefetch_count}")
+            self.ack_batch_size = self.prefetch_count
+        self.requeue_on_error = conf.get("requeue_on_error", AMQPListener.requeue_on_error)
         self.json_callback = lambda data: print(f"Received data {data}")
+        self.executor = None
+        # Delivery tags completed by the workers but not yet acked
+        self._completed_tags = set()
+        self._nacked_tags = set()
+        self._last_acked_tag = 0
+        self._in_flight = 0
 
     def set_callback(self, json_callback):
         self.json_callback = json_callback
@@ -48,10 +81,80 @@ class AMQPListener:
             print(f"Caught exception {e} handling callback")
             traceback.print_exc()
 
+    def create_executor(self):
+        if self.worker_type == 'process':
+            return ProcessPoolExecutor(max_workers=self.workers)
+        elif self.worker_type == 'thread':
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="amqp-worker")
+        else:
+            raise Exception(f"Unknown worker type: {self.worker_type}")
+
+    def pooled_callback(self, ch, method, properties, body):
+        """
+        Decode the message on the I/O thread and hand it to the worker pool.
+        The broker never delivers more than prefetch_count unacked messages,
+        which bounds the number of jobs queued on the executor.
+        """
+        delivery_tag = method.delivery_tag
+        try:
+            data = json.loads(body)
+        except Exception as e:
+            print(f"Caught exception {e} decoding message")
+            self.on_message_done(delivery_tag, False)
+            return
+        self._in_flight += 1
+        future = self.executor.submit(self.json_callback, data)
+        future.add_done_callback(functools.partial(self.on_future_done, delivery_tag))
+
+    def on_future_done(self, delivery_tag, future):
+        # Runs on a worker thread (or the executor management thread), pika
+        # channels may only be used from the I/O thread.
+        success = True
+        exception = future.exception()
+        if exception is not None:
+            print(f"Caught exception {exception} handling callback")
+            traceback.print_exception(type(exception), exception, exception.__traceback__)
+            success = False
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.on_message_done, delivery_tag, success, True))
+
+    def on_message_done(self, delivery_tag, success, from_worker=False):
+        if from_worker:
+            self._in_flight -= 1
+        if not self.channel or not self.channel.is_open:
+            return
+        if not success:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=self.requeue_on_error)
+            self._nacked_tags.add(delivery_tag)
+        self._completed_tags.add(delivery_tag)
+        # Only the contiguous range of completed tags can be acked with multiple=True
+        ready_tag = self._last_acked_tag
+        while ready_tag + 1 in self._completed_tags:
+            ready_tag += 1
+        if ready_tag - self._last_acked_tag >= self.ack_batch_size or \
+                (self._in_flight == 0 and ready_tag > self._last_acked_tag):
+            self.ack_up_to(ready_tag)
+
+    def ack_up_to(self, delivery_tag):
+        # Acking a tag which was already nacked closes the channel, so ack
+        # the highest tag of the range which is still outstanding.
+        ack_tag = None
+        for tag in range(self._last_acked_tag + 1, delivery_tag + 1):
+            self._completed_tags.discard(tag)
+            if tag in self._nacked_tags:
+                self._nacked_tags.discard(tag)
+            else:
+                ack_tag = tag
+        self._last_acked_tag = delivery_tag
+        if ack_tag is not None:
+            self.channel.basic_ack(delivery_tag=ack_tag, multiple=True)
+
     def start(self):
         """
         Start the amqp listener, setting up a callback at @param json_callback
         function with single argument representing a JSON payload.
+        When workers are configured the callback runs on a pool and messages
+        are acked only once the callback has finished.
         """
         print(f"Starting AMQP Listener on {self.host}:{self.port}")
         try:
@@ -69,10 +172,26 @@ class AMQPListener:
         queue_name = self.get_queue_name()
         self.channel.queue_bind(exchange=self.exchange, queue=queue_name,
                                 routing_key=self.routing_key)
-        self.channel.basic_consume(
-            queue=queue_name, on_message_callback=self.callback, auto_ack=True)
+        if self.workers > 0:
+            print(f"Using {self.workers} {self.worker_type} workers, prefetch {self.prefetch_count}, ack batch {self.ack_batch_size}")
+            self.executor = self.create_executor()
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
+            self.channel.basic_consume(
+                queue=queue_name, on_message_callback=self.pooled_callback, auto_ack=False)
+        else:
+            self.channel.basic_consume(
+                queue=queue_name, on_message_callback=self.callback, auto_ack=True)
         print(' [*] Listening for AMQP messages. To exit press CTRL+C')
-        self.channel.start_consuming()
+        try:
+            self.channel.start_consuming()
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+                # Deliver the acks queued by the workers while shutting down
+                if self.connection.is_open:
+                    self.connection.process_data_events(time_limit=0)
 
     def stop(self):
-        self.channel.stop_consuming()
+        if self.connection and self.connection.is_open:
+            self.connection.add_callback_threadsafe(self.channel.stop_consuming)
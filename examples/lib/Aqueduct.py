@@ -4,8 +4,19 @@ import time
 import glob
 import logging
 import os
+import sys
+import shutil
+import sqlite3
+import copy
+import atexit
+import asyncio
+import hashlib
+import uuid
+import base64
+import bisect
+from collections import deque
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock, RLock, Event, Condition, local
 from tabulate import tabulate
 
 logger = logging.getLogger("aqueduct")
@@ -58,6 +69,893 @@ def time_ago(time):
         return str(round(day_diff/30, 2)) + " months ago"
     return str(round(day_diff/365,2)) + " years ago"
 
+class JSONPipelineStore:
+    """
+    Pipelines store persisted in a single JSON file, kept in memory behind a
+    lock. Changes are written behind: a background thread flushes them at
+    most every flush_interval seconds with an atomic rename, and pending
+    changes are flushed on close and at exit. Before each flush, and every
+    flush_interval otherwise, the file is read again when another process
+    replaced it, and its records are merged with the ones changed here, which
+    win. Use the SQLite store for many concurrent writers.
+    Records are dicts with the data, status, lastStatusUpdate, lastUpdate,
+    created and source fields. The ids are kept sorted and indexed by status
+    and source for query.
+    """
+    flush_interval = 1.0
+
+    def __init__(self, dbFile, logger, flush_interval=None):
+        self.dbFile = dbFile
+        self.logger = logger
+        self.flush_interval = JSONPipelineStore.flush_interval if flush_interval is None else flush_interval
+        self._lock = Lock()
+        # Serializes flushes, so an older snapshot never replaces a newer one
+        self._flush_lock = Lock()
+        self._dirty = False
+        # Ids changed since the file was last read or written, all of them after a replace
+        self._changes = set()
+        self._replaced = False
+        self._closed = Event()
+        # Check if db file exists
+        if not os.path.isfile(self.dbFile):
+            self.logger.info('Creating db file: %s', self.dbFile)
+            with open(self.dbFile, 'w') as f:
+                f.write('{}')
+        self._disk = self._stat()
+        with open(self.dbFile, 'r') as f:
+            self._data = json.load(f)
+        # Changes since the store was opened, epoch tells apart reopened stores
+        self._epoch = uuid.uuid4().hex[:8]
+        self._version = 0
+        self._reindex()
+        self._flusher = Thread(target=self._flush_loop, name="pipelines-db-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def _changed(self, ids=None):
+        self._dirty = True
+        self._version += 1
+        if ids is None:
+            self._replaced = True
+        else:
+            self._changes.update(ids)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.dbFile)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _merge_disk(self):
+        """
+        Read the file again when another process replaced it, keeping the
+        records changed here since it was last read or written.
+        """
+        disk = self._stat()
+        if disk == self._disk or disk is None:
+            return
+        try:
+            with open(self.dbFile, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            self.logger.error('Failed to read db file %s changed by another process: %s', self.dbFile, e)
+            return
+        self._disk = disk
+        if self._replaced:
+            return
+        for id in self._changes:
+            if id in self._data:
+                data[id] = self._data[id]
+            else:
+                data.pop(id, None)
+        if data != self._data:
+            self.logger.debug('Merged the changes of db file %s', self.dbFile)
+            self._data = data
+            self._reindex()
+            self._version += 1
+
+    def _reindex(self):
+        self._ids = sorted(self._data)
+        self._by_status = {}
+        self._by_source = {}
+        for id, record in self._data.items():
+            self._index(id, record)
+
+    def _index(self, id, record):
+        self._by_status.setdefault(record["status"], set()).add(id)
+        self._by_source.setdefault(record["source"], set()).add(id)
+
+    def _unindex(self, id, record):
+        for index, key in ((self._by_status, record["status"]), (self._by_source, record["source"])):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del index[key]
+
+    def version(self):
+        with self._lock:
+            return f"{self._epoch}.{self._version}"
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error('Failed to write db file %s: %s', self.dbFile, e)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._merge_disk()
+                if not self._dirty:
+                    return
+                data = json.dumps(self._data, indent=4)
+                changes, replaced = self._changes, self._replaced
+                self._dirty, self._changes, self._replaced = False, set(), False
+            try:
+                tmpFile = f'{self.dbFile}.{os.getpid()}.tmp'
+                with open(tmpFile, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmpFile, self.dbFile)
+            except Exception:
+                # Written again by the next flush
+                with self._lock:
+                    self._dirty = True
+                    self._changes |= changes
+                    self._replaced = self._replaced or replaced
+                raise
+            with self._lock:
+                self._disk = self._stat()
+
+    def load(self):
+        with self._lock:
+            return copy.deepcopy(self._data)
+
+    def replace(self, data):
+        with self._lock:
+            self._data = copy.deepcopy(data)
+            self._reindex()
+            self._changed()
+
+    def get(self, id):
+        with self._lock:
+            record = self._data.get(id, None)
+            return copy.deepcopy(record)
+
+    def add_or_update(self, id, record):
+        """
+        Insert @param record when @param id is unknown, otherwise only update
+        its data and lastUpdate fields. Returns the stored record.
+        """
+        record = copy.deepcopy(record)
+        with self._lock:
+            if id in self._data:
+                self._data[id]["data"] = record["data"]
+                self._data[id]["lastUpdate"] = record["lastUpdate"]
+            else:
+                self._data[id] = record
+                bisect.insort(self._ids, id)
+                self._index(id, record)
+            self._changed([id])
+            return copy.deepcopy(self._data[id])
+
+    def add_or_update_many(self, records):
+        """
+        add_or_update for a dict of id to record, returns the stored records.
+        """
+        return {id: self.add_or_update(id, record) for id, record in records.items()}
+
+    def update_status(self, id, status, timestamp):
+        """
+        Set the status of pipeline @param id. Returns the previous status, or
+        None when the pipeline is not in the store.
+        """
+        return self.update_status_many([id], status, timestamp)[id]
+
+    def update_status_many(self, ids, status, timestamp):
+        """
+        Set the status of all pipelines in @param ids at once. Returns a dict
+        of id to previous status, None for pipelines not in the store.
+        """
+        previous = {}
+        with self._lock:
+            for id in ids:
+                if id not in self._data:
+                    previous[id] = None
+                    continue
+                previous[id] = self._data[id]["status"]
+                self._unindex(id, self._data[id])
+                self._data[id]["status"] = status
+                self._index(id, self._data[id])
+                self._data[id]["lastStatusUpdate"] = timestamp
+            self._changed([id for id in ids if previous[id] is not None])
+        return previous
+
+    def delete(self, id):
+        with self._lock:
+            record = self._data.pop(id, None)
+            if record is not None:
+                self._unindex(id, record)
+                del self._ids[bisect.bisect_left(self._ids, id)]
+                self._changed([id])
+
+    def query(self, statuses=None, sources=None, since=None, until=None, after=None, limit=None):
+        """
+        Return (records, more) with the records matching all the given filters
+        in id order, starting after id @param after, at most @param limit of
+        them. @param statuses and @param sources are lists of accepted values,
+        @param since and @param until bound lastStatusUpdate (inclusive). more
+        tells whether there are records after the last one returned.
+        """
+        with self._lock:
+            candidates = None
+            for index, keys in ((self._by_status, statuses), (self._by_source, sources)):
+                if keys is not None:
+                    ids = set().union(*[index.get(key, set()) for key in keys])
+                    candidates = ids if candidates is None else candidates & ids
+            if candidates is None:
+                ids = self._ids[bisect.bisect_right(self._ids, after):] if after is not None else self._ids
+            else:
+                ids = sorted(id for id in candidates if after is None or id > after)
+            records = {}
+            for id in ids:
+                record = self._data[id]
+                if since is not None and record["lastStatusUpdate"] < since:
+                    continue
+                if until is not None and record["lastStatusUpdate"] > until:
+                    continue
+                if limit is not None and len(records) == limit:
+                    return records, True
+                records[id] = copy.deepcopy(record)
+            return records, False
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+class SQLitePipelineStore:
+    """
+    Pipelines store in a SQLite database in WAL mode with one row per
+    pipeline, so status updates only touch a single row.
+    """
+    FIELDS = ["status", "lastStatusUpdate", "lastUpdate", "created", "source"]
+
+    def __init__(self, dbFile, logger):
+        self.dbFile = dbFile
+        self.logger = logger
+        # sqlite3 connections can't be shared across threads
+        self._local = local()
+        conn = self._connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS pipelines (
+                            id TEXT PRIMARY KEY,
+                            data TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            lastStatusUpdate INTEGER NOT NULL,
+                            lastUpdate INTEGER NOT NULL,
+                            created INTEGER NOT NULL,
+                            source TEXT NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS pipelines_status ON pipelines(status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS pipelines_source ON pipelines(source)")
+            conn.execute("CREATE INDEX IF NOT EXISTS pipelines_lastStatusUpdate ON pipelines(lastStatusUpdate)")
+            # Bumped on every change by any process using the database
+            conn.execute("CREATE TABLE IF NOT EXISTS pipelines_version (version INTEGER NOT NULL)")
+            conn.execute("INSERT INTO pipelines_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM pipelines_version)")
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS pipelines_version_{event.lower()} AFTER {event} ON pipelines
+                                 BEGIN UPDATE pipelines_version SET version = version + 1; END""")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbFile, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_record(row):
+        record = {"data": json.loads(row["data"])}
+        for field in SQLitePipelineStore.FIELDS:
+            record[field] = row[field]
+        return record
+
+    def load(self):
+        rows = self._connection().execute("SELECT * FROM pipelines ORDER BY rowid")
+        return {row["id"]: self._to_record(row) for row in rows}
+
+    def replace(self, data):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM pipelines")
+            for id, record in data.items():
+                self._insert(conn, id, record)
+
+    def _insert(self, conn, id, record, on_conflict=""):
+        conn.execute("INSERT INTO pipelines (id, data, status, lastStatusUpdate, lastUpdate, created, source) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?) " + on_conflict,
+                     (id, json.dumps(record["data"]), record["status"], record["lastStatusUpdate"],
+                      record["lastUpdate"], record["created"], record["source"]))
+
+    def get(self, id):
+        row = self._connection().execute("SELECT * FROM pipelines WHERE id = ?", (id,)).fetchone()
+        return self._to_record(row) if row is not None else None
+
+    def add_or_update(self, id, record):
+        return self.add_or_update_many({id: record})[id]
+
+    def add_or_update_many(self, records):
+        conn = self._connection()
+        with conn:
+            for id, record in records.items():
+                self._insert(conn, id, record,
+                             "ON CONFLICT(id) DO UPDATE SET data = excluded.data, lastUpdate = excluded.lastUpdate")
+        return {id: self.get(id) for id in records}
+
+    def update_status(self, id, status, timestamp):
+        return self.update_status_many([id], status, timestamp)[id]
+
+    def update_status_many(self, ids, status, timestamp):
+        previous = {}
+        conn = self._connection()
+        with conn:
+            for id in ids:
+                row = conn.execute("SELECT status FROM pipelines WHERE id = ?", (id,)).fetchone()
+                previous[id] = row["status"] if row is not None else None
+            conn.executemany("UPDATE pipelines SET status = ?, lastStatusUpdate = ? WHERE id = ?",
+                             [(status, timestamp, id) for id in ids if previous[id] is not None])
+        return previous
+
+    def delete(self, id):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM pipelines WHERE id = ?", (id,))
+
+    def version(self):
+        return str(self._connection().execute("SELECT version FROM pipelines_version").fetchone()["version"])
+
+    def query(self, statuses=None, sources=None, since=None, until=None, after=None, limit=None):
+        """
+        Same as JSONPipelineStore.query, with the filters run by SQLite.
+        """
+        where = []
+        params = []
+        for field, values in (("status", statuses), ("source", sources)):
+            if values is not None:
+                where.append(f"{field} IN ({', '.join('?' * len(values))})")
+                params += list(values)
+        for condition, value in (("lastStatusUpdate >= ?", since), ("lastStatusUpdate <= ?", until), ("id > ?", after)):
+            if value is not None:
+                where.append(condition)
+                params.append(value)
+        sql = "SELECT * FROM pipelines"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        rows = self._connection().execute(sql, params).fetchall()
+        more = limit is not None and len(rows) > limit
+        return {row["id"]: self._to_record(row) for row in rows[:limit]}, more
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+def open_pipeline_store(dbFile, logger):
+    """
+    Return the pipelines store for @param dbFile, SQLite for .sqlite, .sqlite3
+    and .db files and JSON otherwise.
+    """
+    if os.path.splitext(dbFile)[1].lower() in ('.sqlite', '.sqlite3', '.db'):
+        return SQLitePipelineStore(dbFile, logger)
+    return JSONPipelineStore(dbFile, logger)
+
+class PipelinesIndex:
+    """
+    Index of the pipeline definitions of a folder, mapping each pipeline id
+    to the file defining it and the hash of that file. The index is saved
+    next to the pipeline files, so files which didn't change since the last
+    run are not parsed again, and it is refreshed from the file stats when a
+    file changes. Pipelines defined in more than one file are reported when
+    the index is built, and the first file in name order wins.
+    """
+    INDEX_FILE = '.pipelines-index.json'
+
+    def __init__(self, path, logger, indexFile=None, ignore=()):
+        self.path = path
+        self.logger = logger.getChild("index")
+        self.indexFile = indexFile if indexFile else os.path.join(path, PipelinesIndex.INDEX_FILE)
+        # Files of the folder which are not pipeline definitions, like a db.json
+        self.ignore = set(os.path.abspath(f) for f in ignore)
+        self._lock = Lock()
+        # file -> {"mtime", "size", "ino", "hash", "ids"}
+        self.files = {}
+        # id -> file
+        self.ids = {}
+        # id -> files, for pipelines defined in several files
+        self.duplicates = {}
+        # file -> ((mtime, size, ino), hash, pipelines) for the files parsed so far
+        self._parsed = {}
+        try:
+            with open(self.indexFile) as f:
+                self.files = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning('Ignoring invalid index file %s: %s', self.indexFile, e)
+        self.refresh()
+
+    def _save(self):
+        tmpFile = self.indexFile + '.tmp'
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump(self.files, f)
+            os.replace(tmpFile, self.indexFile)
+        except Exception as e:
+            self.logger.warning('Failed to save index file %s: %s', self.indexFile, e)
+
+    @staticmethod
+    def _stat_key(stat):
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _parse(self, aqueduct_file, stat=None):
+        """
+        Returns the (hash, pipelines) of @param aqueduct_file, which is only
+        read again when its stat changed and parsed again when its content did.
+        """
+        key = self._stat_key(stat if stat is not None else os.stat(aqueduct_file))
+        cached = self._parsed.get(aqueduct_file)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+        with open(aqueduct_file, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        pipelines = cached[2] if cached is not None and cached[1] == digest else json.loads(content)
+        self._parsed[aqueduct_file] = (key, digest, pipelines)
+        return digest, pipelines
+
+    def _pipelines(self, aqueduct_file):
+        """
+        Returns the pipelines of the indexed @param aqueduct_file, from the
+        cache when it was parsed with the stat of its index entry.
+        """
+        entry = self.files[aqueduct_file]
+        cached = self._parsed.get(aqueduct_file)
+        if cached is not None and cached[0] == (entry["mtime"], entry["size"], entry.get("ino")):
+            return cached[2]
+        try:
+            return self._parse(aqueduct_file)[1]
+        except Exception as e:
+            # Keep the last valid content of a file being written
+            if cached is not None:
+                return cached[2]
+            self.logger.error('Error loading pipeline: %s: %s', aqueduct_file, e)
+            return {}
+
+    def _stale(self, aqueduct_file):
+        entry = self.files.get(aqueduct_file)
+        try:
+            stat = os.stat(aqueduct_file)
+        except OSError:
+            return True
+        return entry is None or (entry["mtime"], entry["size"], entry.get("ino")) != self._stat_key(stat)
+
+    def refresh(self):
+        """
+        Re-read the files whose stat changed and rebuild the id map.
+        Returns the set of files whose content changed.
+        """
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        changed = set()
+        found = set()
+        for aqueduct_file in glob.glob(self.path + '/*.json'):
+            if os.path.abspath(aqueduct_file) in self.ignore:
+                continue
+            found.add(aqueduct_file)
+            if not self._stale(aqueduct_file):
+                continue
+            try:
+                stat = os.stat(aqueduct_file)
+                digest, pipelines = self._parse(aqueduct_file, stat)
+            except Exception as e:
+                # Keep the last valid content of a file being written
+                self.logger.error('Error loading pipeline: %s: %s', aqueduct_file, e)
+                if aqueduct_file not in self.files:
+                    found.discard(aqueduct_file)
+                continue
+            previous = self.files.get(aqueduct_file)
+            if previous is None or previous["hash"] != digest:
+                changed.add(aqueduct_file)
+            self.files[aqueduct_file] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "ino": stat.st_ino,
+                                         "hash": digest, "ids": list(pipelines.keys())}
+        for aqueduct_file in list(self.files.keys()):
+            if aqueduct_file not in found:
+                del self.files[aqueduct_file]
+                self._parsed.pop(aqueduct_file, None)
+                changed.add(aqueduct_file)
+
+        ids = {}
+        duplicates = {}
+        for aqueduct_file in sorted(self.files.keys()):
+            for id in self.files[aqueduct_file]["ids"]:
+                if id in ids:
+                    duplicates.setdefault(id, [ids[id]]).append(aqueduct_file)
+                    continue
+                ids[id] = aqueduct_file
+        for id, files in duplicates.items():
+            if self.duplicates.get(id) != files:
+                self.logger.error('Pipeline %s is defined in several files %s, using %s', id, files, files[0])
+        self.ids = ids
+        self.duplicates = duplicates
+        if changed:
+            self._save()
+        return changed
+
+    def lookup(self, id):
+        """
+        Returns the (file, hash) defining pipeline @param id, or None.
+        """
+        with self._lock:
+            aqueduct_file = self.ids.get(id)
+            if aqueduct_file is None:
+                return None
+            return aqueduct_file, self.files[aqueduct_file]["hash"]
+
+    def get(self, id):
+        """
+        Returns the definition of pipeline @param id, or None. Only the file
+        defining the pipeline is checked for changes, its parsed content is
+        cached until its stat changes.
+        """
+        with self._lock:
+            aqueduct_file = self.ids.get(id)
+            if aqueduct_file is None or self._stale(aqueduct_file):
+                self._refresh()
+                aqueduct_file = self.ids.get(id)
+                if aqueduct_file is None:
+                    return None
+            return self._pipelines(aqueduct_file).get(id)
+
+    def definitions(self):
+        """
+        Returns a dict of id to (file, definition) for all indexed pipelines,
+        parsing each file at most once.
+        """
+        with self._lock:
+            definitions = {}
+            for aqueduct_file in sorted(self.files.keys()):
+                pipelines = self._pipelines(aqueduct_file)
+                for id in self.files[aqueduct_file]["ids"]:
+                    if self.ids.get(id) == aqueduct_file and id in pipelines:
+                        definitions[id] = (aqueduct_file, pipelines[id])
+            return definitions
+
+class PipelinesFolderWatcher:
+    """
+    Reports which pipelines of a folder were added, changed or removed since
+    the previous scan, using a PipelinesIndex so files are only read again
+    when their stat changed and only parsed when their content changed.
+    wait() returns early on inotify events when inotify_simple is
+    available, and simply sleeps otherwise.
+    """
+    # Time to gather more events after the first one, editors often write
+    # a file in several steps
+    debounce = 0.2
+
+    def __init__(self, path, logger, index=None):
+        self.path = path
+        self.logger = logger.getChild("folderwatch")
+        self.index = index if index is not None else PipelinesIndex(path, logger)
+        # id -> (file, pipeline data) as of the last scan
+        self.pipelines = {}
+        self.inotify = None
+        try:
+            from inotify_simple import INotify, flags
+            self.inotify = INotify()
+            self.inotify.add_watch(self.path, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                                              flags.DELETE | flags.CREATE)
+            self.logger.info('Watching %s with inotify', self.path)
+        except Exception as e:
+            self.logger.info('inotify not available (%s), polling %s', e, self.path)
+            self.inotify = None
+
+    def scan(self):
+        """
+        Returns the (added, changed, removed) pipelines since the last scan.
+        added and changed are dicts of id to (file, pipeline data), removed is
+        a list of ids.
+        """
+        self.index.refresh()
+        pipelines = self.index.definitions()
+        added = {id: value for id, value in pipelines.items() if id not in self.pipelines}
+        changed = {id: value for id, value in pipelines.items()
+                    if id in self.pipelines and self.pipelines[id][1] != value[1]}
+        removed = [id for id in self.pipelines if id not in pipelines]
+        self.pipelines = pipelines
+        return added, changed, removed
+
+    def wait(self, timeout):
+        """
+        Wait up to @param timeout seconds for a change in the folder.
+        """
+        if self.inotify is None:
+            time.sleep(timeout)
+            return
+        if self.inotify.read(timeout=int(timeout * 1000)):
+            # Drain the events that follow the first one
+            while self.inotify.read(timeout=int(self.debounce * 1000)):
+                pass
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+class StatusChangeLog:
+    """
+    Bounded log of pipeline status changes, each one numbered in sequence. A
+    resume token identifies the last change seen by a client, so it can ask
+    for only the changes it missed. Tokens of a previous process, or older
+    than the changes kept, can't be resumed and the client has to reload the
+    full status.
+    """
+    maxlen = 10000
+
+    def __init__(self, maxlen=None):
+        # Changes to the token of another process are not comparable
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.changes = deque(maxlen=maxlen or StatusChangeLog.maxlen)
+        self._condition = Condition()
+        # list of (loop, future) for the coroutines waiting for a change
+        self._async_waiters = []
+
+    def token(self, seq=None):
+        return f"{self.epoch}-{self.seq if seq is None else seq}"
+
+    def _parse(self, token):
+        try:
+            epoch, seq = token.rsplit("-", 1)
+            return epoch, int(seq)
+        except (AttributeError, ValueError):
+            return None, None
+
+    def append(self, id, status, lastStatusUpdate):
+        """
+        Record the new @param status of pipeline @param id, status None when
+        the pipeline was deleted.
+        """
+        with self._condition:
+            self.seq += 1
+            self.changes.append({"seq": self.seq, "sourceId": id, "status": status, "lastStatusUpdate": lastStatusUpdate})
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(Pipelines._resolve_waiter, future, True)
+
+    def since(self, token):
+        """
+        Return (changes, token) with the changes after @param token and the
+        token of the latest change. changes is None when @param token can't be
+        resumed.
+        """
+        epoch, seq = self._parse(token)
+        with self._condition:
+            latest = self.token()
+            if epoch != self.epoch or seq > self.seq:
+                return None, latest
+            first = self.changes[0]["seq"] if self.changes else self.seq + 1
+            if seq < first - 1:
+                return None, latest
+            return [dict(change) for change in self.changes if change["seq"] > seq], latest
+
+    def _pending(self, token):
+        epoch, seq = self._parse(token)
+        return epoch != self.epoch or seq != self.seq
+
+    def wait(self, token, timeout):
+        """
+        Block until there are changes after @param token, returns False on timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending(token), timeout)
+
+    async def wait_async(self, token, timeout):
+        """
+        Coroutine version of wait.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._condition:
+            if self._pending(token):
+                return True
+            self._async_waiters.append((loop, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._condition:
+                if (loop, future) in self._async_waiters:
+                    self._async_waiters.remove((loop, future))
+
+class _WatchViewOutput:
+    """
+    Stream of the terminal below a PipelinesWatchView, anything written to it
+    makes the view redraw entirely.
+    """
+    def __init__(self, view, stream):
+        self.view = view
+        self.stream = stream
+
+    def write(self, data):
+        with self.view._output_lock:
+            self.view._overwritten = True
+            return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class PipelinesWatchView:
+    """
+    Terminal view of the pipelines db for the watch modes, with a header of
+    the pipeline and message counts. A background thread redraws it every
+    refresh_interval seconds, reading the db again only when status messages
+    arrived since the last redraw. On a terminal only the lines which changed
+    are rewritten, in place with ANSI escape sequences, and the whole view is
+    redrawn after anything else (prints, logging) wrote to the terminal;
+    otherwise the whole view is printed after each change.
+    """
+    refresh_interval = 1.0
+    COLUMNS = ['Id', 'Status', 'Last Status Update', 'Last Update', 'Created']
+
+    def __init__(self, pipelines, refresh_interval=None, stream=None):
+        self.pipelines = pipelines
+        self.refresh_interval = PipelinesWatchView.refresh_interval if refresh_interval is None else refresh_interval
+        self.stream = stream or sys.stdout
+        self.ansi = self.stream.isatty()
+        self.messages = 0
+        self._lock = Lock()
+        self._dirty = True
+        self._db = {}
+        # Lines currently on screen
+        self._lines = []
+        # Set when other output was written over the view
+        self._overwritten = False
+        self._output_lock = RLock()
+        # (object, attribute or None for a logging handler, original stream)
+        self._redirected = []
+        self._rate_messages = 0
+        self._rate_time = time.time()
+        self._closed = Event()
+        self._thread = Thread(target=self._loop, name="pipelines-watch-view", daemon=True)
+
+    def start(self):
+        if self.ansi:
+            self._redirect()
+        self._thread.start()
+        return self
+
+    def _redirect(self):
+        """
+        Route sys.stdout, sys.stderr and the logging handlers writing to them
+        through a _WatchViewOutput, so their output doesn't leave the view
+        half rewritten.
+        """
+        streams = {}
+        for name in ('stdout', 'stderr'):
+            stream = getattr(sys, name)
+            if stream is None or isinstance(stream, _WatchViewOutput) or not stream.isatty():
+                continue
+            streams[id(stream)] = _WatchViewOutput(self, stream)
+            self._redirected.append((sys, name, stream))
+            setattr(sys, name, streams[id(stream)])
+        loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                           if isinstance(logger, logging.Logger)]
+        for logger in loggers:
+            for handler in logger.handlers:
+                if isinstance(handler, logging.StreamHandler) and id(handler.stream) in streams:
+                    self._redirected.append((handler, None, handler.setStream(streams[id(handler.stream)])))
+
+    def _restore(self):
+        for target, name, stream in reversed(self._redirected):
+            if name is None:
+                target.setStream(stream)
+            else:
+                setattr(target, name, stream)
+        self._redirected = []
+
+    def message_received(self):
+        with self._lock:
+            self.messages += 1
+            self._dirty = True
+
+    def refresh(self):
+        """
+        Read the pipelines db again on the next redraw.
+        """
+        with self._lock:
+            self._dirty = True
+
+    def _loop(self):
+        while True:
+            try:
+                self.render()
+            except Exception as e:
+                print(e)
+            if self._closed.wait(self.refresh_interval):
+                return
+
+    def _header(self, messages, now):
+        counts = {}
+        for pipeline in self._db.values():
+            counts[pipeline['status']] = counts.get(pipeline['status'], 0) + 1
+        rate = (messages - self._rate_messages) / max(now - self._rate_time, 1e-6)
+        self._rate_messages, self._rate_time = messages, now
+        statuses = ', '.join(f"{status}: {count}" for status, count in sorted(counts.items(), key=lambda item: str(item[0])))
+        return f"{datetime.now().strftime('%H:%M:%S')}  Pipelines: {len(self._db)} ({statuses})  Messages: {messages} ({rate:.1f}/s)"
+
+    def _table(self):
+        rows = [PipelinesWatchView.COLUMNS]
+        for id, pipeline in self._db.items():
+            rows.append([str(id), str(pipeline['status']), time_ago(pipeline['lastStatusUpdate']),
+                         datetime.fromtimestamp(pipeline['lastUpdate']).strftime('%m/%d/%Y, %H:%M:%S'),
+                         datetime.fromtimestamp(pipeline['created']).strftime('%m/%d/%Y, %H:%M:%S')])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(PipelinesWatchView.COLUMNS))]
+        rule = '  '.join('-' * width for width in widths)
+        return [rule] + ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows] + [rule]
+
+    def render(self):
+        with self._lock:
+            dirty, messages = self._dirty, self.messages
+            self._dirty = False
+        if dirty:
+            self._db = self.pipelines.getDB()
+        lines = [self._header(messages, time.time())] + self._table()
+        if not self.ansi:
+            if dirty:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            return
+        # Lines below the bottom of the terminal can't be rewritten in place
+        height = shutil.get_terminal_size().lines - 1
+        if len(lines) > height:
+            lines = lines[:height - 1] + [f"... {len(lines) - height + 1} more lines"]
+        with self._output_lock:
+            # Other output may have scrolled the terminal, the lines on
+            # screen are unknown
+            if self._overwritten:
+                self._overwritten = False
+                self._lines = []
+            out = ["\033[H\033[2J"] if not self._lines else []
+            for i, line in enumerate(lines):
+                if i >= len(self._lines) or self._lines[i] != line:
+                    out.append(f"\033[{i + 1};1H{line}\033[K")
+            if len(lines) < len(self._lines):
+                out.append(f"\033[{len(lines) + 1};1H\033[J")
+            out.append(f"\033[{len(lines) + 1};1H")
+            self.stream.write(''.join(out))
+            self.stream.flush()
+            self._lines = lines
+
+    def close(self):
+        self._closed.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._restore()
+
 class Pipelines:
     def __init__(self, path, pipelinesDBFile, publisher, _logger):
         self.path = path
@@ -74,98 +972,207 @@ class Pipelines:
         else:
             self.logger.getChild("init").warning('Pipelines path is empty, will not load any pipelines or save pipelines data')
 
-        # Check if db file exists
-        if not os.path.isfile(self.pipelinesDBFile):
-            self.logger.getChild("init").info('Creating db file: %s', self.pipelinesDBFile)
-            with open(self.pipelinesDBFile, 'w') as f:
-                f.write('{}')
+        self.store = open_pipeline_store(self.pipelinesDBFile, self.logger.getChild("store"))
+        # Index of the pipeline definitions in the pipelines folder
+        self.index = PipelinesIndex(self.path, self.logger, ignore=[self.pipelinesDBFile]) if self.path != "" else None
+        # Status waiters, woken by updateStatusPipeline as soon as a status arrives
+        self._waiters_lock = Lock()
+        # id -> Condition for the threads waiting on the pipeline
+        self._status_conditions = {}
+        # id -> list of (loop, future, waitFor) for the coroutines waiting on the pipeline
+        self._async_waiters = {}
+        # Status changes for the clients streaming them
+        self.changes = StatusChangeLog()
+        # Terminal view of the watch modes, see watch
+        self.view = None
 
     def getDB(self):
         if self.path == "":
             return {}
-        with open(self.pipelinesDBFile, 'r') as f:
-            data = json.load(f)
-            return data
+        return self.store.load()
 
     def writeDB(self, data):
         if self.path == "":
             return
-        with open(self.pipelinesDBFile, 'w') as f:
-            json.dump(data, f, indent=4)
+        self.store.replace(data)
+
+    def watch(self, refresh_interval=None):
+        """
+        Start the terminal view of the pipelines, redrawn at most every
+        @param refresh_interval seconds.
+        """
+        if self.view is None and self.path != "":
+            self.view = PipelinesWatchView(self, refresh_interval).start()
+        return self.view
+
+    def close(self):
+        """
+        Persist any pending change and release the store.
+        """
+        if self.view is not None:
+            self.view.close()
+        self.store.close()
+
+    def exportDB(self, json_file):
+        """
+        Write all pipelines to @param json_file in the JSON db format.
+        """
+        with open(json_file, 'w') as f:
+            json.dump(self.getDB(), f, indent=4)
+
+    def importDB(self, json_file):
+        """
+        Replace the pipelines db with the content of @param json_file.
+        """
+        with open(json_file) as f:
+            self.writeDB(json.load(f))
 
     def handle_message(self, watch_mode, method, props, body):
         routing_key = method.routing_key
-        print(f" [x] Received {routing_key}: {body}")
+        if not watch_mode:
+            print(f" [x] Received {routing_key}: {body}")
         try:
             message = json.loads(body)
             if routing_key.startswith("aqueduct.status"):
                 self.logger.debug(f"Pipeline '{message['sourceId']}' status: {message['cause']}")
                 self.updateStatusPipeline(message['sourceId'], message['cause'])
-            if watch_mode:
-                self.print_pipelines_db(datetime.now().strftime("%H:%M:%S"), self.getDB(), clear=True)
-        except Exception as e:
-            print(e)
-    def anypipe_message(self, method, props, body, json_file):
-        routing_key = method.routing_key
-        print(f" [x] Received {routing_key}: {body}")
-        try:
-            message = json.loads(body)
-            if json_file != "":
-                # Append message to json file
-                with open(json_file, 'a') as f:
-                    f.write(json.dumps(message) + "\n")
+            view = self.watch() if watch_mode else None
+            if view is not None:
+                view.message_received()
         except Exception as e:
             print(e)
+    def anypipe_message(self, method, props, body, recorder):
+        """
+        Record the anypipe message @param body with the Recorder.JSONLRecorder
+        @param recorder, which writes it from its own thread.
+        """
+        if recorder is not None:
+            recorder.record(body)
 
     def exists(self, id):
-        pipelines_db = self.getDB()
-        return id in pipelines_db
+        if self.path == "":
+            return False
+        return self.store.get(id) is not None
 
-    def ps(self):
+    def ps(self, statuses=None, sources=None, since=None, until=None, cursor=None, limit=None):
+        """
+        Print the pipelines matching the query filters, see query.
+        """
         if self.path == "":
             self.logger.getChild("ps").warning('Pipelines path is empty, will not load any pipelines or save pipelines data')
             return
         self.updateDBFromDisk()
-        data = self.getDB()
+        data, next_cursor = self.query(statuses, sources, since, until, cursor, limit)
         self.print_pipelines_db("Pipelines", data)
+        if next_cursor is not None:
+            print(f"More pipelines, next cursor: {next_cursor}")
+
+    @staticmethod
+    def _encode_cursor(id):
+        return base64.urlsafe_b64encode(id.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            return base64.b64decode(cursor.encode(), altchars=b'-_', validate=True).decode()
+        except Exception:
+            raise ValueError(f"Invalid cursor: {cursor}")
+
+    def query(self, statuses=None, sources=None, since=None, until=None, cursor=None, limit=None):
+        """
+        Return (pipelines, cursor) with the pipelines db entries in id order
+        whose status is in @param statuses, whose source file is in @param
+        sources and whose lastStatusUpdate is between @param since and @param
+        until, each filter applying only when given. Pages hold at most
+        @param limit pipelines, the returned cursor gives the next page and
+        is None on the last one.
+        """
+        if self.path == "":
+            return {}, None
+        if sources is not None:
+            sources = [os.path.basename(source).replace('.json', '') for source in sources]
+        after = self._decode_cursor(cursor) if cursor else None
+        records, more = self.store.query(statuses, sources, since, until, after, limit)
+        next_cursor = self._encode_cursor(list(records)[-1]) if more and records else None
+        return records, next_cursor
+
+    def queryETag(self, *filters):
+        """
+        Entity tag for the result of query with the same arguments. It changes
+        whenever the pipelines db does, and is computed without running the query.
+        """
+        version = self.store.version() if self.path != "" else ""
+        key = hashlib.sha1(json.dumps([version, filters], default=str).encode()).hexdigest()[:16]
+        return f'"{key}"'
 
 
     def updateStatusPipeline(self, id, status):
         if self.path == "":
             return
-        pipelines_db = self.getDB()
-        if id in pipelines_db:
-            self.logger.info(f"Pipeline {id}, changed status from {pipelines_db[id]['status']} to {status}")
-            pipelines_db[id]["status"] = status
-            pipelines_db[id]['lastStatusUpdate'] = int(datetime.now().timestamp())
-        else:
-            self.logger.error(f"Pipeline {id} not found in db")
-        self.writeDB(pipelines_db)
+        self.updateStatusPipelines([id], status)
+
+    def updateStatusPipelines(self, ids, status):
+        if self.path == "" or not ids:
+            return
+        timestamp = int(datetime.now().timestamp())
+        previous_status = self.store.update_status_many(ids, status, timestamp)
+        for id, previous in previous_status.items():
+            if previous is not None:
+                self.logger.info(f"Pipeline {id}, changed status from {previous} to {status}")
+                self.changes.append(id, status, timestamp)
+            else:
+                self.logger.error(f"Pipeline {id} not found in db")
+            self.notifyStatus(id, status if previous is not None else None)
+
+    def _status_condition(self, id):
+        with self._waiters_lock:
+            if id not in self._status_conditions:
+                self._status_conditions[id] = Condition()
+            return self._status_conditions[id]
+
+    @staticmethod
+    def _resolve_waiter(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    def notifyStatus(self, id, status):
+        """
+        Wake the threads and coroutines waiting on pipeline @param id, @param status
+        is None when the pipeline no longer exists.
+        """
+        with self._waiters_lock:
+            condition = self._status_conditions.get(id)
+            for loop, future, waitFor in self._async_waiters.get(id, []):
+                if status is None or status in waitFor:
+                    loop.call_soon_threadsafe(self._resolve_waiter, future, status is not None)
+        if condition is not None:
+            with condition:
+                condition.notify_all()
 
     def addOrUpdatePipeline(self, id, source, data):
+        self.addOrUpdatePipelines({id: data}, source)
+
+    def addOrUpdatePipelines(self, pipelines, source):
         source = os.path.basename(source).replace('.json', '')
         if self.path == "":
-            logger.warn(f"Cannot add or update pipeline {id}")
-        pipelines_db = self.getDB()
+            logger.warn(f"Cannot add or update pipelines {list(pipelines.keys())}")
+            return
         lastUpdate = int(datetime.now().timestamp())
-        if id in pipelines_db:
-            if source != pipelines_db[id]['source']:
-                self.logger.error(f"Error while updating {id}, source was added by another file {pipelines_db[id]['source']}, but found in {source}")
-            pipelines_db[id]["data"] = data
-            pipelines_db[id]["lastUpdate"] = lastUpdate
-        else:
-            status = "loaded"
-            lastStatusUpdate = 0
-            created = int(datetime.now().timestamp())
-            pipelines_db[id] = {"data": data, "status": status, "lastStatusUpdate": lastStatusUpdate, "lastUpdate": lastUpdate, "created": created, "source": source}
-
-        self.writeDB(pipelines_db)
+        status = "loaded"
+        lastStatusUpdate = 0
+        created = lastUpdate
+        records = {}
+        for id, data in pipelines.items():
+            records[id] = {"data": data, "status": status, "lastStatusUpdate": lastStatusUpdate, "lastUpdate": lastUpdate, "created": created, "source": source}
+        for id, stored in self.store.add_or_update_many(records).items():
+            if source != stored['source']:
+                self.logger.error(f"Error while updating {id}, source was added by another file {stored['source']}, but found in {source}")
 
     def print_pipelines_db(self, title, pipelines_db, clear=False):
         if self.path == "":
             return []
         if clear:
-            os.system('cls' if os.name in ('nt', 'dos') else 'clear')
+            print("\033[H\033[2J", end="")
         print(title)
         table = [['Id', 'Status', 'Last Status Update', 'Last Update', 'Created']]
         for id, pipeline  in pipelines_db.items():
@@ -176,27 +1183,23 @@ class Pipelines:
         print(tabulate(table))
 
     def updateDBFromDisk(self):
-        for aqueduct_file in glob.glob(self.path + '/*.json'):
-            try:
-                with open(aqueduct_file) as f:
-                    data = json.load(f)
-                    for pipeline in data:
-                        self.addOrUpdatePipeline(pipeline, aqueduct_file, data[pipeline])
-            except Exception as e:
-                self.logger.getChild("updateDBFromDisk").error('Error loading pipeline: %s', aqueduct_file)
-                print(e)
+        if self.index is None:
+            return
+        # Same resolution of duplicated ids as get(): the first file wins
+        self.index.refresh()
+        by_file = {}
+        for id, (aqueduct_file, pipeline) in self.index.definitions().items():
+            by_file.setdefault(aqueduct_file, {})[id] = pipeline
+        for aqueduct_file, pipelines in by_file.items():
+            self.addOrUpdatePipelines(pipelines, aqueduct_file)
 
     def get(self, id):
         if self.path == "":
             return None
-        for pipeline in glob.glob(self.path + '/*.json'):
-            try:
-                with open(pipeline) as f:
-                    data = json.load(f)
-                    if id in data:
-                        return data[id]
-            except:
-                self.logger.getChild("get").warning('Failed to load pipeline: %s', pipeline)
+        try:
+            return self.index.get(id)
+        except Exception as e:
+            self.logger.getChild("get").warning('Failed to load pipeline %s: %s', id, e)
         return None
 
     def runFolderWatch(self):
@@ -222,14 +1225,101 @@ class Pipelines:
             self.addOrUpdatePipeline(id, source, pipeline)
             self.runPipeline(id, pipeline)
 
-    def runPipeline(self, id, pipeline):
-        logger.info("Running pipeline: %s", id)
-        msg = pipeline
+    @staticmethod
+    def executeMessage(id, pipeline):
+        msg = dict(pipeline)
         msg["command"] = "execute"
         msg["sourceId"] = id
-        self.publisher.publish(json.dumps(msg), 'execute', "." + id)
+        return json.dumps(msg)
+
+    def runPipeline(self, id, pipeline):
+        logger.info("Running pipeline: %s", id)
+        self.publisher.publish(self.executeMessage(id, pipeline), 'execute', "." + id)
         self.updateStatusPipeline(id, "execute_sent")
 
+    async def runFromFileAsync(self, source_file, publisher):
+        with open(source_file) as f:
+            data = json.load(f)
+        return await self.runAsync(data, publisher, source_file)
+
+    async def runAsync(self, pipelines, publisher, source="unknown"):
+        """
+        Bulk version of run: add all @param pipelines to the db in one batch
+        and launch them with launchPipelinesAsync. @param publisher is an
+        AsyncAMQP.AsyncAqueductAMQP.
+        """
+        print("Running pipelines from: ", source)
+        self.addOrUpdatePipelines(pipelines, source)
+        return await self.launchPipelinesAsync(pipelines, publisher)
+
+    async def launchPipelinesAsync(self, pipelines, publisher):
+        """
+        Publish the execute message of all @param pipelines without waiting for
+        each publisher confirm in turn, then set the status of the pipelines
+        the broker accepted in a single db update.
+        Returns a dict of id to True when accepted or the publish error.
+        """
+        logger = self.logger.getChild("launch")
+        ids = list(pipelines.keys())
+        messages = [(self.executeMessage(id, pipelines[id]), 'execute', "." + id) for id in ids]
+        results = dict(zip(ids, await publisher.publish_batch(messages)))
+        accepted = [id for id, result in results.items() if result is True]
+        for id, result in results.items():
+            if result is not True:
+                logger.error("Pipeline %s was not accepted by the broker: %s", id, result)
+        logger.info("Launched %d pipelines, %d accepted", len(ids), len(accepted))
+        self.updateStatusPipelines(accepted, "execute_sent")
+        return results
+
+    async def stopPipelinesAsync(self, ids, publisher):
+        """
+        Bulk version of stopPipeline, see launchPipelinesAsync.
+        """
+        logger = self.logger.getChild("stop")
+        messages = [(json.dumps({"command": "stop", "sourceId": id}), 'execute', "." + id) for id in ids]
+        results = dict(zip(ids, await publisher.publish_batch(messages)))
+        for id, result in results.items():
+            if result is not True:
+                logger.error("Stop of pipeline %s was not accepted by the broker: %s", id, result)
+        self.updateStatusPipelines([id for id, result in results.items() if result is True], "stop_sent")
+        return results
+
+    async def runFolderWatchChangesAsync(self, watcher, publisher):
+        """
+        Incremental version of runFolderWatchAsync: only pipelines added or
+        changed since the previous call of @param watcher (a
+        PipelinesFolderWatcher) are executed, and removed ones are stopped.
+        """
+        if self.path == "":
+            self.logger.getChild("runFolder").warning('Pipelines path is empty, will not load any pipelines or save pipelines data')
+            return {}
+        added, changed, removed = watcher.scan()
+        if added or changed or removed:
+            self.logger.info("Pipelines changes: %d added, %d changed, %d removed", len(added), len(changed), len(removed))
+        updated = {**added, **changed}
+        by_file = {}
+        for id, (aqueduct_file, data) in updated.items():
+            by_file.setdefault(aqueduct_file, {})[id] = data
+        for aqueduct_file, pipelines in by_file.items():
+            self.addOrUpdatePipelines(pipelines, aqueduct_file)
+        results = {}
+        if updated:
+            results.update(await self.launchPipelinesAsync({id: data for id, (_, data) in updated.items()}, publisher))
+        if removed:
+            results.update(await self.stopPipelinesAsync(removed, publisher))
+        return results
+
+    async def runFolderWatchAsync(self, publisher):
+        """
+        Bulk version of runFolderWatch.
+        """
+        if self.path == "":
+            self.logger.getChild("runFolder").warning('Pipelines path is empty, will not load any pipelines or save pipelines data')
+            return {}
+        self.updateDBFromDisk()
+        pipelines = {id: pipeline["data"] for id, pipeline in self.getDB().items()}
+        return await self.launchPipelinesAsync(pipelines, publisher)
+
     def stopPipeline(self, id):
         logger.info("Stopping pipeline: %s", id)
         msg = {"command": "stop", "sourceId": id}
@@ -242,33 +1332,105 @@ class Pipelines:
             self.stopPipeline(id)
         except Exception as e:
             print(e)
-        self.getDB().pop(id, None)
-        self.writeDB(self.getDB())
+        self.removePipeline(id)
+
+    async def deletePipelineAsync(self, id, publisher):
+        logger.info("Deleting pipeline: %s", id)
+        try:
+            await self.stopPipelinesAsync([id], publisher)
+        except Exception as e:
+            print(e)
+        self.removePipeline(id)
+
+    def removePipeline(self, id):
+        if self.path != "":
+            self.store.delete(id)
+            self.changes.append(id, None, int(datetime.now().timestamp()))
+        self.notifyStatus(id, None)
+
+    def statusEvents(self, token=None):
+        """
+        Return (events, token) with the (token, event, data) status events for
+        a client that last saw @param token, and the token to resume from. A
+        client that can't resume gets a "snapshot" event with the status of
+        all pipelines, otherwise a "status" event per change it missed.
+        """
+        changes, latest = self.changes.since(token)
+        if changes is not None:
+            return [(self.changes.token(change.pop("seq")), "status", change) for change in changes], latest
+        # The changes from the snapshot on are sent again on the next call
+        snapshot = {id: {"status": pipeline["status"], "lastStatusUpdate": pipeline["lastStatusUpdate"]}
+                    for id, pipeline in self.getDB().items()}
+        return [(latest, "snapshot", snapshot)], latest
 
     def status(self, id):
-        pipelines_db = self.getDB()
-        if id in pipelines_db:
-            return pipelines_db[id]['status']
+        pipeline = self.store.get(id) if self.path != "" else None
+        if pipeline is not None:
+            return pipeline['status']
         else:
             return "not found"
 
     def waitPipeline(self, id, waitFor, timeout):
         logger.info("Waiting for pipeline: %s, timeout: %d", id, timeout)
         t0 = time.time()
-        while True:
-            if timeout > 0 and time.time() - t0 > timeout:
-                logger.error("Timeout waiting for pipeline: %s", id)
-                return False
-            pipelines_db = self.getDB()
-            if id not in pipelines_db:
+        condition = self._status_condition(id)
+        # The status is checked and waited for under the condition, so a
+        # status notified in between can't be missed
+        with condition:
+            while True:
+                pipeline = self.store.get(id) if self.path != "" else None
+                if pipeline is None:
+                    logger.error("Wait: Pipeline not found: %s", id)
+                    return False
+                if pipeline['status'] in waitFor:
+                    logger.info("Wait: Pipeline %s: %s", pipeline['status'], id )
+                    return True
+                else:
+                    logger.info("Wait pipeline '%s' status: %s", id, pipeline['status'])
+                remaining = None
+                if timeout > 0:
+                    remaining = timeout - (time.time() - t0)
+                    if remaining <= 0:
+                        logger.error("Timeout waiting for pipeline: %s", id)
+                        return False
+                condition.wait(remaining)
+
+    async def waitPipelineAsync(self, id, waitFor, timeout):
+        """
+        Coroutine version of waitPipeline, resolved by the status subscriber
+        thread without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future, waitFor)
+        # Register before checking the current status, so no update is missed
+        with self._waiters_lock:
+            self._async_waiters.setdefault(id, []).append(waiter)
+        try:
+            pipeline = self.store.get(id) if self.path != "" else None
+            if pipeline is None:
                 logger.error("Wait: Pipeline not found: %s", id)
                 return False
-            if pipelines_db[id]['status'] in waitFor:
-                logger.info("Wait: Pipeline %s: %s", pipelines_db[id]['status'], id )
+            if pipeline['status'] in waitFor:
                 return True
-            else:
-                logger.info("Wait pipeline '%s' status: %s", id, pipelines_db[id]['status'])
-            time.sleep(1)
+            try:
+                return await asyncio.wait_for(future, timeout if timeout > 0 else None)
+            except asyncio.TimeoutError:
+                logger.error("Timeout waiting for pipeline: %s", id)
+                return False
+        finally:
+            with self._waiters_lock:
+                self._async_waiters[id].remove(waiter)
+                if not self._async_waiters[id]:
+                    del self._async_waiters[id]
+
+    async def waitPipelinesAsync(self, ids, waitFor, timeout):
+        """
+        Wait for all pipelines in @param ids concurrently, returns a dict
+        of id to the waitPipelineAsync result.
+        """
+        results = await asyncio.gather(*[self.waitPipelineAsync(id, waitFor, timeout) for id in ids])
+        return dict(zip(ids, results))
 
     def stop(self, pipeline):
         logger = self.logger.getChild("stop")
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+import json
+import asyncio
+import logging
+import traceback
+import aio_pika
+
+logger = logging.getLogger("amqp-async")
+
+async def connect(host='localhost', port=5672, username='guest', password='guest'):
+    """
+    Open a robust asyncio AMQP connection. A single connection can be shared by
+    any number of AsyncAMQPListener and AsyncAqueductAMQP objects, each of them
+    uses its own channel on top of it.
+    """
+    return await aio_pika.connect_robust(host=host, port=int(port), login=username, password=password)
+
+class AsyncAMQPListener:
+    """
+    Asyncio counterpart of AMQPListener. Iterate the listener to receive the
+    decoded JSON payloads:
+
+        async for data in listener:
+            ...
+    """
+    host = 'localhost'
+    exchange = 'anypipe'
+    routing_key = '#'
+    port = 5672
+    username = 'guest'
+    password = 'guest'
+    prefetch_count = 100
+
+    def __init__(self, conf, connection=None):
+        self.host = conf.get("host", AsyncAMQPListener.host)
+        self.exchange = conf.get("exchange", AsyncAMQPListener.exchange)
+        self.routing_key = conf.get("routing_key", AsyncAMQPListener.routing_key)
+        self.port = conf.get("port", AsyncAMQPListener.port)
+        self.username = conf.get("username", AsyncAMQPListener.username)
+        self.password = conf.get("password", AsyncAMQPListener.password)
+        self.prefetch_count = int(conf.get("prefetch_count", AsyncAMQPListener.prefetch_count))
+        self.connection = connection
+        self.owns_connection = connection is None
+        self.channel = None
+        self.queue = None
+
+    async def connect(self):
+        if not self.connection:
+            self.connection = await connect(self.host, self.port, self.username, self.password)
+        if not self.channel:
+            self.channel = await self.connection.channel()
+            await self.channel.set_qos(prefetch_count=self.prefetch_count)
+            exchange = await self.channel.declare_exchange(self.exchange, aio_pika.ExchangeType.TOPIC, durable=True)
+            self.queue = await self.channel.declare_queue('', exclusive=True)
+            await self.queue.bind(exchange, routing_key=self.routing_key)
+            logger.info(f"Using queue name {self.queue.name}")
+
+    async def messages(self):
+        await self.connect()
+        async with self.queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                try:
+                    data = json.loads(message.body)
+                except Exception as e:
+                    print(f"Caught exception {e} decoding message")
+                    await message.reject()
+                    continue
+                yield data
+                # The consumer is back for the next message, so this one was handled
+                await message.ack()
+
+    def __aiter__(self):
+        return self.messages()
+
+    async def start(self, json_callback):
+        """
+        Await @param json_callback (a coroutine function with a single JSON
+        payload argument) for every message received until stopped.
+        """
+        async for data in self:
+            try:
+                await json_callback(data)
+            except Exception as e:
+                print(f"Caught exception {e} handling callback")
+                traceback.print_exc()
+
+    async def stop(self):
+        if self.channel and not self.channel.is_closed:
+            await self.channel.close()
+        self.channel = None
+        if self.owns_connection and self.connection and not self.connection.is_closed:
+            await self.connection.close()
+            self.connection = None
+
+class AsyncAqueductAMQP:
+    """
+    Asyncio counterpart of Aqueduct.AqueductAMQP with the same topics.
+    """
+    def __init__(self, name, amqpHost, amqpPort, amqpUsername, amqpPassword, logger, connection=None):
+        self.logger = logger.getChild("aqueduct-amqp-async").getChild(name)
+        self._host = amqpHost
+        self._port = amqpPort
+        self._username = amqpUsername
+        self._password = amqpPassword
+        self._conn = connection
+        self._owns_conn = connection is None
+        self._channel = None
+        self._exchange = None
+
+    async def connect(self):
+        if not self._conn:
+            self.logger.info('Connecting to AMQP instance: %s:%s', self._host, self._port)
+            self._conn = await connect(self._host, self._port, self._username, self._password)
+        # Publisher confirms are enabled, and unroutable messages are reported
+        # as errors, so a publish only succeeds once the broker accepted it
+        self._channel = await self._conn.channel(publisher_confirms=True, on_return_raises=True)
+        self._exchange = await self._channel.declare_exchange("aqueduct", aio_pika.ExchangeType.TOPIC, durable=True)
+
+    def _choose_routing_key(self, topic):
+        if topic == "execute":
+            return 'aqueduct.execute.default'
+        elif topic == "control":
+            return 'aqueduct.control.default'
+        elif topic == "status":
+            return 'aqueduct.status.#'
+        elif topic == "everything":
+            return '#'
+        else:
+            raise Exception("Unknown topic: " + topic)
+
+    async def publish(self, msg, topic=None, suffix=""):
+        if self._exchange is None:
+            raise Exception('Not connected to queue')
+        routing_key = self._choose_routing_key(topic) + suffix
+        self.logger.info('publishing message: \'%s\' to exchange: "%s" and routing_key: "%s"', msg, 'aqueduct', routing_key)
+        await self._exchange.publish(aio_pika.Message(body=msg.encode(), content_type='application/json'),
+                                     routing_key=routing_key)
+        self.logger.debug('message sent: %s', msg)
+
+    async def publish_batch(self, messages):
+        """
+        Publish all (msg, topic, suffix) tuples in @param messages at once and
+        wait for all the publisher confirms together. Returns a list with True
+        for each message the broker accepted and the error otherwise.
+        """
+        results = await asyncio.gather(*[self.publish(msg, topic, suffix) for msg, topic, suffix in messages],
+                                       return_exceptions=True)
+        return [True if result is None else result for result in results]
+
+    async def messages(self, exchange="aqueduct", topic=None):
+        """
+        Yield every message received on @param topic of @param exchange.
+        """
+        if self._channel is None:
+            raise Exception('Not connected to queue')
+        self.logger.debug('subscribing to "%s":"%s"', exchange, self._choose_routing_key(topic))
+        channel = await self._conn.channel()
+        amqp_exchange = await channel.declare_exchange(exchange, aio_pika.ExchangeType.TOPIC, durable=True)
+        queue = await channel.declare_queue('', exclusive=True)
+        await queue.bind(amqp_exchange, routing_key=self._choose_routing_key(topic))
+        try:
+            async with queue.iterator(no_ack=True) as queue_iter:
+                async for message in queue_iter:
+                    yield message
+        finally:
+            await channel.close()
+
+    async def subscribe(self, callback, exchange="aqueduct", topic=None):
+        """
+        Call @param callback with the pika style (channel, method, properties, body)
+        arguments for each message. The incoming message provides both the
+        routing_key of method and the headers of properties.
+        """
+        async for message in self.messages(exchange, topic):
+            callback(self._channel, message, message, message.body)
+
+    async def close(self):
+        if self._channel and not self._channel.is_closed:
+            await self._channel.close()
+        if self._owns_conn and self._conn and not self._conn.is_closed:
+            self.logger.debug('closing queue connection')
+            await self._conn.close()
@@ -1,53 +1,272 @@
 import requests
 from PIL import Image
 import numpy as np
+import os
+import shutil
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from threading import Lock
+from collections import OrderedDict
 from requests.adapters import HTTPAdapter, Retry
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter which counts the connections opened by its pools, so callers
+    can tell how many requests reused a keep-alive connection.
+    """
+    def __init__(self, *args, **kwargs):
+        self.new_connections = 0
+        self._stats_lock = Lock()
+        super().__init__(*args, **kwargs)
+
+    def count_new_connection(self):
+        with self._stats_lock:
+            self.new_connections += 1
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            def _new_conn(self):
+                adapter.count_new_connection()
+                return super()._new_conn()
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                adapter.count_new_connection()
+                return super()._new_conn()
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+class ImageCache:
+    """
+    Thread-safe LRU cache of encoded images keyed by source and image id,
+    bounded by the total size of the cached images and optionally by the size
+    cached for each source. Entries expire after ttl seconds when ttl is set.
+    """
+    def __init__(self, max_bytes, ttl=0, max_source_bytes=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_source_bytes = max_source_bytes
+        self._lock = Lock()
+        # (source_id, image) -> (data, expiration time)
+        self._entries = OrderedDict()
+        # source_id -> OrderedDict of the keys cached for the source, in LRU order
+        self._source_keys = {}
+        self._source_bytes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        data, _ = self._entries.pop(key)
+        source_id = key[0]
+        del self._source_keys[source_id][key]
+        self._source_bytes[source_id] -= len(data)
+        if not self._source_keys[source_id]:
+            del self._source_keys[source_id]
+            del self._source_bytes[source_id]
+        self.size -= len(data)
+
+    def get(self, source_id, image):
+        key = (source_id, str(image))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] and entry[1] < time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._source_keys[source_id].move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, source_id, image, data):
+        key = (source_id, str(image))
+        size = len(data)
+        if size > self.max_bytes or (self.max_source_bytes and size > self.max_source_bytes):
+            return
+        expires = time.time() + self.ttl if self.ttl else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, expires)
+            self._source_keys.setdefault(source_id, OrderedDict())[key] = True
+            self._source_bytes[source_id] = self._source_bytes.get(source_id, 0) + size
+            self.size += size
+            if self.max_source_bytes:
+                while self._source_bytes[source_id] > self.max_source_bytes:
+                    self._remove(next(iter(self._source_keys[source_id])))
+                    self.evictions += 1
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._source_keys.clear()
+            self._source_bytes.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "sources": dict(self._source_bytes),
+            }
 
 class MCPClient:
+    # Number of keep-alive connections kept per host
+    pool_size = 10
+    retries = 2
+    backoff_factor = 0.3
+    status_forcelist = (500, 502, 504)
+    # Size of the chunks written while streaming segments and images to disk
+    chunk_size = 64*1024
+
     def __init__(self, conf):
         self.host = conf.get("host", "mcp")
         self.port = conf.get("port", 9097)
         self.user = conf.get("username", None)
         self.password = conf.get("password", None)
+        self.pool_size = int(conf.get("pool_size", MCPClient.pool_size))
+        self.retries = int(conf.get("retries", MCPClient.retries))
+        self.backoff_factor = float(conf.get("backoff_factor", MCPClient.backoff_factor))
+        self.status_forcelist = conf.get("status_forcelist", MCPClient.status_forcelist)
+        self.chunk_size = int(conf.get("chunk_size", MCPClient.chunk_size))
+        # Optional cache of the encoded images returned by get_image, disabled
+        # unless a size is configured
+        self.image_cache = None
+        image_cache_bytes = int(conf.get("image_cache_bytes", 0))
+        if image_cache_bytes > 0:
+            self.image_cache = ImageCache(image_cache_bytes,
+                                          ttl=float(conf.get("image_cache_ttl", 0)),
+                                          max_source_bytes=int(conf.get("image_cache_source_bytes", 0)))
+        self.requests_count = 0
+        self._stats_lock = Lock()
+        # One long lived session shared by all threads. Sessions are safe to
+        # share for plain requests, the urllib3 pools underneath are locked.
+        self.session = self.requests_retry_session()
         if self.user and self.password:
             print(f"Connecting to mcp://{self.user}:*****@{self.host}:{self.port}")
         else:
             print(f"Connecting to mcp://{self.host}:{self.port}")
 
     # See https://www.peterbe.com/plog/best-practice-with-retries-with-requests
-    def requests_retry_session(
-        retries=2,
-        backoff_factor=0.3,
-        status_forcelist=(500, 502, 504),
-        session=None,):
-
+    def requests_retry_session(self, session=None):
         session = session or requests.Session()
         retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist,
+            total=self.retries,
+            read=self.retries,
+            connect=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.status_forcelist,
         )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
+        # MCP is a single host, so all the pooled connections go to it
+        self.adapter = CountingHTTPAdapter(max_retries=retry,
+                                           pool_connections=2,
+                                           pool_maxsize=self.pool_size)
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        if self.user and self.password:
+            session.auth = (self.user, self.password)
         return session
 
-    def get(self, url, timeout=5):
-        if self.user and self.password:
-            auth = (self.user, self.password)
-        else:
-            auth = None
+    def get_connection_stats(self):
+        """
+        Return the number of requests sent, connections opened and requests
+        which were served on a reused keep-alive connection.
+        """
+        with self._stats_lock:
+            requests_count = self.requests_count
+        new_connections = self.adapter.new_connections
+        return {
+            "requests": requests_count,
+            "new_connections": new_connections,
+            "reused_connections": max(0, requests_count - new_connections),
+        }
+
+    def close(self):
+        self.session.close()
+
+    def get(self, url, timeout=5, stream=False, headers=None):
+        with self._stats_lock:
+            self.requests_count += 1
         # Retry periodic timeouts, abort any response over 5 seconds
-        response = self.requests_retry_session().get(url, auth=auth, timeout=timeout)
+        response = self.session.get(url, timeout=timeout, stream=stream, headers=headers)
 
         if response.status_code == 401:
                 raise Exception("Unauthorized")
         else:
             return response
 
+    def write_response(self, response, writable, write_through=False):
+        """
+        Write the body of a streamed @param response to @param writable chunk
+        by chunk, without holding the whole body in memory. With
+        @param write_through the raw socket stream is copied straight into
+        the writable using its own buffer.
+        """
+        written = 0
+        if write_through:
+            response.raw.decode_content = True
+            start = writable.tell() if writable.seekable() else 0
+            shutil.copyfileobj(response.raw, writable, self.chunk_size)
+            if writable.seekable():
+                written = writable.tell() - start
+        else:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                writable.write(chunk)
+                written += len(chunk)
+        return written
+
+    def stream_to_file(self, url, filepath, description, timeout=5, resume=False, write_through=False):
+        """
+        Stream @param url into @param filepath. With @param resume, a partially
+        downloaded file is completed with a Range request when the server
+        supports it, and restarted otherwise.
+        """
+        headers = None
+        offset = 0
+        if resume and os.path.isfile(filepath):
+            offset = os.path.getsize(filepath)
+            if offset > 0:
+                headers = {"Range": f"bytes={offset}-"}
+        with self.get(url, timeout=timeout, stream=True, headers=headers) as response:
+            if response.status_code == 416 and offset > 0:
+                # Complete only when the file on disk has the size of the one
+                # on the server, from "Content-Range: bytes */<size>"
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                if total.isdigit() and int(total) == offset:
+                    return 0
+                print(f"Partial {description} at {filepath} doesn't match the server size {total or 'unknown'}, restarting it")
+                os.remove(filepath)
+            else:
+                if response.status_code == 404:
+                    raise Exception(f"{description} not found")
+                if response.status_code not in (200, 206):
+                    raise Exception(f"Error downloading {description} to {filepath}", response.status_code)
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                with open(filepath, mode) as f:
+                    return self.write_response(response, f, write_through)
+        return self.stream_to_file(url, filepath, description, timeout, False, write_through)
+
     # curl mcp:9097/hlsfs/source
     def list_sources(self):
         url = f"http://{self.host}:{self.port}/hlsfs/source"
@@ -58,64 +277,135 @@ class MCPClient:
         url = f"http://{self.host}:{self.port}/hlsfs/source/{source_id}/stats"
         return self.get(url).json()
 
+    def get_image_cache_stats(self):
+        if self.image_cache is None:
+            return None
+        return self.image_cache.get_stats()
+
     # curl mcp:9097/hlsfs/source/<source_id>/image/<image>
-    def get_image(self, source_id, image):
-        url = f"http://{self.host}:{self.port}/hlsfs/source/{source_id}/image/{image}"
-        response = self.get(url)
+    def get_image(self, source_id, image, format="numpy", color="RGB", reduce=1, out=None):
+        """
+        Return the image as a numpy array, or the encoded bytes when @param format
+        is "source". See decode_image() for @param color, @param reduce and @param out.
+        Images are served from the image cache when it is enabled.
+        """
+        data = None
+        if self.image_cache is not None:
+            data = self.image_cache.get(source_id, image)
+        if data is None:
+            url = f"http://{self.host}:{self.port}/hlsfs/source/{source_id}/image/{image}"
+            response = self.get(url)
 
-        if response.status_code != 200:
-            if response.status_code == 404:
-                raise Exception("Image not found")
-            else:
-                raise Exception("Error downloading image", response.status_code)
-        else:
-            # Convert image to numpy array
-            img = Image.open(BytesIO(response.content))
-            arr = np.array(img)
-            return arr
+            if response.status_code != 200:
+                if response.status_code == 404:
+                    raise Exception("Image not found")
+                else:
+                    raise Exception("Error downloading image", response.status_code)
+            data = response.content
+            if self.image_cache is not None:
+                self.image_cache.put(source_id, image, data)
+        if format == "source":
+            return data
+        return self.decode_image(data, color, reduce, out)
+
+    @staticmethod
+    def check_output_array(out, shape):
+        if out is None:
+            return None
+        if out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous or not out.flags.writeable:
+            raise Exception(f"Output array must be a writable contiguous uint8 array of shape {shape}, got {out.shape} {out.dtype}")
+        return out
+
+    def decode_image(self, data, color="RGB", reduce=1, out=None):
+        """
+        Decode the encoded image in @param data straight from the response
+        buffer into a HxWx3 uint8 array.
+
+        @param color is the channel order of the result, "RGB" or "BGR" (OpenCV)
+        @param reduce decodes at 1/2, 1/4 or 1/8 of the resolution, which JPEG
+        decoders do much faster than a full decode
+        @param out is an optional preallocated array, reused across calls, which
+        receives the decoded image when its shape matches
+        """
+        color = color.upper()
+        if color not in ("RGB", "BGR"):
+            raise Exception(f"Unsupported color order {color}")
+        if reduce not in (1, 2, 4, 8):
+            raise Exception(f"Unsupported reduce factor {reduce}")
+        try:
+            import cv2
+        except ImportError:
+            cv2 = None
+
+        if cv2 is not None:
+            flags = {1: cv2.IMREAD_COLOR,
+                     2: cv2.IMREAD_REDUCED_COLOR_2,
+                     4: cv2.IMREAD_REDUCED_COLOR_4,
+                     8: cv2.IMREAD_REDUCED_COLOR_8}[reduce]
+            # frombuffer wraps the response bytes without copying them
+            bgr = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+            if bgr is None:
+                raise Exception("Error decoding image")
+            out = self.check_output_array(out, bgr.shape)
+            if color == "RGB":
+                return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=out)
+            if out is None:
+                return bgr
+            np.copyto(out, bgr)
+            return out
+
+        img = Image.open(BytesIO(data))
+        if reduce > 1:
+            # JPEG draft mode scales while decoding, other formats are
+            # resized after it to the size cv2 returns for them
+            size = img.size
+            img.draft('RGB', (img.width // reduce, img.height // reduce))
+            if img.size == size:
+                img = img.resize((max(1, img.width // reduce), max(1, img.height // reduce)), Image.BILINEAR)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        pixels = np.asarray(img)
+        if color == "BGR":
+            pixels = pixels[..., ::-1]
+        out = self.check_output_array(out, pixels.shape)
+        if out is None:
+            return np.array(pixels)
+        np.copyto(out, pixels)
+        return out
 
     # curl mcp:9097/hlsfs/source/<source_id>/segment/<video>
-    def download_video(self, source_id, video, filepath):
+    def download_video(self, source_id, video, filepath, resume=False, write_through=False):
         url = f"http://{self.host}:{self.port}/hlsfs/source/{source_id}/segment/{video}"
-        response = self.get(url, timeout=5*60)
-
-        if response.status_code != 200:
-            if response.status_code == 404:
-                raise Exception(f"Video {video} not found for source {source_id}")
-            else:
-                raise Exception(f"Error downloading video {video} to {filepath} for source {source_id}", response.status_code)
-        else:
-            # Save image to file
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+        # Segments are streamed to disk, only one chunk is held in memory at a time
+        return self.stream_to_file(url, filepath, f"Video {video} for source {source_id}",
+                                   timeout=5*60, resume=resume, write_through=write_through)
 
     # curl mcp:9097/hlsfs/source/<source_id>/segment/<segment>
-    def get_segment(self, source_id, segment):
+    def get_segment(self, source_id, segment, writable=None):
+        """
+        Stream a segment into @param writable, or into a new BytesIO when no
+        writable is provided. Returns the writable.
+        """
         url = f"http://{self.host}:{self.port}/hlsfs/source/{source_id}/segment/{segment}"
-        response = self.get(url, timeout=5*60)
-
-        if response.status_code != 200:
-            if response.status_code == 404:
-                raise Exception("Segment not found")
+        with self.get(url, timeout=5*60, stream=True) as response:
+            if response.status_code != 200:
+                if response.status_code == 404:
+                    raise Exception("Segment not found")
+                else:
+                    raise Exception("Error downloading Segment", response.status_code)
             else:
-                raise Exception("Error downloading Segment", response.status_code)
-        else:
-            return BytesIO(response.content)
+                if writable is None:
+                    writable = BytesIO()
+                    self.write_response(response, writable)
+                    writable.seek(0)
+                else:
+                    self.write_response(response, writable)
+                return writable
 
     # curl mcp:9097/hlsfs/source/<source_id>/segment/<image>
-    def download_image(self, source_id, image, filepath):
+    def download_image(self, source_id, image, filepath, resume=False, write_through=False):
         url = f"http://{self.host}:{self.port}/hlsfs/source/{source_id}/segment/{image}"
-        response = self.get(url)
-
-        if response.status_code != 200:
-            if response.status_code == 404:
-                raise Exception("Image not found")
-            else:
-                raise Exception("Error downloading image", response.status_code)
-        else:
-            # Save image to file
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+        return self.stream_to_file(url, filepath, "Image", resume=resume, write_through=write_through)
 
     # curl mcp:9097/hlsfs/source/<source_id>/image
     def list_images(self, source_id):
@@ -131,7 +421,11 @@ class MCPClient:
             return response.json()
 
     # curl mcp:9097/hlsfs/source/<source_id>/latest-image
-    def get_latest_image(self, source_id):
+    def get_latest_image(self, source_id, format="numpy", color="RGB", reduce=1, out=None):
+        """
+        Return the image as a numpy array, or the encoded bytes when @param format
+        is "source". See decode_image() for @param color, @param reduce and @param out.
+        """
         url = f"http://{self.host}:{self.port}/hlsfs/source/{source_id}/latest-image"
         response = self.get(url)
 
@@ -141,10 +435,9 @@ class MCPClient:
             else:
                 raise Exception("Error downloading image", response.status_code)
         else:
-            # Convert image to numpy array
-            img = Image.open(BytesIO(response.content))
-            arr = np.array(img)
-            return arr
+            if format == "source":
+                return response.content
+            return self.decode_image(response.content, color, reduce, out)
 
     # curl mcp:9097/hlsfs/source/<source_id>/live
     def get_live_m3u8(self, source_id):
@@ -172,13 +465,80 @@ class MCPClient:
         else:
             return response.text
 
+    @staticmethod
+    def strip_unsupported_m3u8_tags(m3u8_content):
+        # Remove all #EXT-UNIX-TIMESTAMP-MS lines from the m3u8 file
+        # m3u8 library doesn't support this tag
+        return '\n'.join([line for line in m3u8_content.split('\n') if not line.startswith("#EXT-UNIX-TIMESTAMP-MS")])
+
     # curl mcp:9097/hlsfs/source/<source_id>/<start>..<end>.m3u8
     def get_m3u8_playlist(self, source_id, start, end):
         import m3u8
-        m3u8_content = self.get_m3u8(source_id, start, end)
-        # Remove all #EXT-UNIX-TIMESTAMP-MS lines from the m3u8 file
-        # m3u8 library doesn't support this tag
-        m3u8_content = '\n'.join([line for line in m3u8_content.split('\n') if not line.startswith("#EXT-UNIX-TIMESTAMP-MS")])
+        m3u8_content = self.strip_unsupported_m3u8_tags(self.get_m3u8(source_id, start, end))
         return m3u8.loads(m3u8_content)
 
+    def download_segment_with_retry(self, source_id, video, filepath, retries):
+        attempt = 0
+        while True:
+            try:
+                # Resume so a retry only fetches what the failed attempt missed
+                self.download_video(source_id, video, filepath, resume=attempt > 0)
+                return os.path.getsize(filepath)
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                print(f"Retrying download of {video} for source {source_id} after error: {e}")
+                time.sleep(self.backoff_factor * (2 ** attempt))
+
+    def download_range(self, source_id, start, end, dest_dir, concurrency=4, retries=2):
+        """
+        Download the playlist for the @param start to @param end range (epoch
+        seconds) of @param source_id and all of its segments to @param dest_dir,
+        fetching up to @param concurrency segments at once. Each segment is
+        retried @param retries times before the download fails.
+
+        Returns a dict with the m3u8 content (without unsupported tags), the
+        parsed playlist, the segment names relative to @param dest_dir, the
+        number of bytes downloaded, the elapsed time and throughput.
+        """
+        import m3u8
+        t0 = time.time()
+        m3u8_content = self.strip_unsupported_m3u8_tags(self.get_m3u8(source_id, start, end))
+        playlist = m3u8.loads(m3u8_content)
+        dest_dir = Path(dest_dir)
+        downloads = []
+        for segment in playlist.segments:
+            filepath_ts = dest_dir / Path(segment.uri)
+            filepath_ts.parent.mkdir(parents=True, exist_ok=True)
+            video_name = filepath_ts.relative_to(filepath_ts.parent.parent)
+            downloads.append((video_name, filepath_ts))
+
+        total_bytes = 0
+        errors = []
+        # Keep concurrency within the connection pool, so connections are reused
+        workers = max(1, min(concurrency, self.pool_size, len(downloads)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mcp-download") as executor:
+            futures = [(video_name, executor.submit(self.download_segment_with_retry, source_id, video_name, filepath_ts, retries))
+                        for video_name, filepath_ts in downloads]
+            for video_name, future in futures:
+                try:
+                    total_bytes += future.result()
+                except Exception as e:
+                    errors.append(f"{video_name}: {e}")
+        elapsed = time.time() - t0
+        if errors:
+            raise Exception(f"Error downloading {len(errors)} of {len(downloads)} segments for source {source_id}", errors)
+        throughput = total_bytes / elapsed if elapsed > 0 else 0
+        print(f"Downloaded {len(downloads)} segments ({total_bytes} bytes) for source {source_id} "
+              f"in {elapsed:.2f}s, {throughput/(1024*1024):.2f} MiB/s")
+        return {
+            "m3u8": m3u8_content,
+            "playlist": playlist,
+            "segments": [video_name for video_name, _ in downloads],
+            "bytes": total_bytes,
+            "seconds": elapsed,
+            "throughput": throughput,
+        }
+
 
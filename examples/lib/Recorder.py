@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import gzip
+import queue
+import atexit
+import traceback
+from datetime import datetime
+from threading import Thread, Lock
+
+class JSONLRecorder:
+    """
+    Record AMQP message bodies to JSON lines files, one message per line.
+    record() only queues the body, a writer thread does the file I/O, so the
+    AMQP thread is never blocked on disk. Messages arriving while the queue
+    is full are dropped and counted.
+    """
+    # File to record to. With rotation or split_by_source enabled the files
+    # are named after it, e.g. dump.jsonl -> dump-<sourceId>-<date>-<n>.jsonl
+    path = 'dump.jsonl'
+    # "none", "gzip" or "zstd" (requires the zstandard package)
+    compression = 'none'
+    # Maximum messages waiting for the writer thread
+    queue_size = 100000
+    # Start a new file once this many uncompressed bytes were written to it, zero disables
+    max_bytes = 0
+    # Start a new file once it has been open for this many seconds, zero disables
+    rotate_seconds = 0
+    # Record each sourceId to its own files
+    split_by_source = False
+    # Maximum seconds between flushes of the files
+    flush_interval = 1.0
+    # Seconds between the stats printed by the writer thread, zero disables
+    report_interval = 10
+
+    EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, conf):
+        self.path = conf.get("path", JSONLRecorder.path)
+        self.compression = conf.get("compression", JSONLRecorder.compression) or 'none'
+        if self.compression not in JSONLRecorder.EXTENSIONS:
+            raise Exception(f"Unknown compression: {self.compression}")
+        if self.compression == 'zstd':
+            # Fail now rather than in the writer thread on the first message
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("zstd compression requires the zstandard package, pip install zstandard")
+        self.queue_size = int(conf.get("queue_size", JSONLRecorder.queue_size))
+        self.max_bytes = int(conf.get("max_bytes", JSONLRecorder.max_bytes))
+        self.rotate_seconds = float(conf.get("rotate_seconds", JSONLRecorder.rotate_seconds))
+        self.split_by_source = conf.get("split_by_source", JSONLRecorder.split_by_source)
+        self.flush_interval = float(conf.get("flush_interval", JSONLRecorder.flush_interval))
+        self.report_interval = float(conf.get("report_interval", JSONLRecorder.report_interval))
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self._lock = Lock()
+        self.received = 0
+        self.dropped = 0
+        self.written = 0
+        self.bytes = 0
+        self.files = []
+        # key (sourceId or None) -> [file, path, bytes, opened]
+        self._open = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._started = time.time()
+            self._thread = Thread(target=self._write_loop, name="jsonl-recorder", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def record(self, body):
+        """
+        Queue the message @param body (bytes or str of a JSON object) for writing.
+        Returns False when it was dropped.
+        """
+        with self._lock:
+            self.received += 1
+        try:
+            self.queue.put_nowait(body)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def _filename(self, source_id):
+        base, ext = os.path.splitext(self.path)
+        name = base
+        if source_id is not None:
+            name += '-' + "".join(c if c.isalnum() or c in '-_.' else '_' for c in source_id)
+        if self.max_bytes > 0 or self.rotate_seconds > 0:
+            # Rotated files sort by name in the order they were written
+            name += '-' + datetime.now().strftime('%Y%m%d-%H%M%S')
+            n = 0
+            while os.path.exists(f"{name}-{n:04d}{ext}{JSONLRecorder.EXTENSIONS[self.compression]}"):
+                n += 1
+            name = f"{name}-{n:04d}"
+        return name + ext + JSONLRecorder.EXTENSIONS[self.compression]
+
+    def _open_file(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.compression == 'gzip':
+            return gzip.open(path, 'ab', compresslevel=6)
+        if self.compression == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor().stream_writer(open(path, 'ab'), closefd=True)
+        return open(path, 'ab', buffering=1024 * 1024)
+
+    def _file(self, source_id, size):
+        now = time.time()
+        entry = self._open.get(source_id)
+        if entry is not None:
+            expired = self.rotate_seconds > 0 and now - entry[3] >= self.rotate_seconds
+            full = self.max_bytes > 0 and entry[2] > 0 and entry[2] + size > self.max_bytes
+            if expired or full:
+                entry[0].close()
+                entry = None
+        if entry is None:
+            path = self._filename(source_id)
+            entry = [self._open_file(path), path, 0, now]
+            self._open[source_id] = entry
+            self.files.append(path)
+        return entry
+
+    def _write(self, body):
+        if isinstance(body, str):
+            body = body.encode()
+        source_id = None
+        # The body is written as it was received unless it has to be
+        # decoded, for its sourceId or to fit in a single line
+        if self.split_by_source or b'\n' in body:
+            message = json.loads(body)
+            if b'\n' in body:
+                body = json.dumps(message).encode()
+            if self.split_by_source:
+                source_id = str(message.get('sourceId', 'unknown'))
+        line = body + b'\n'
+        entry = self._file(source_id, len(line))
+        entry[0].write(line)
+        entry[2] += len(line)
+        self.written += 1
+        self.bytes += len(line)
+
+    def _flush(self):
+        for entry in self._open.values():
+            entry[0].flush()
+
+    def _write_loop(self):
+        last_flush = last_report = time.time()
+        last_written = 0
+        while True:
+            try:
+                body = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                body = None
+            if body is StopIteration:
+                break
+            if body is not None:
+                try:
+                    self._write(body)
+                except Exception as e:
+                    print(f"Caught exception {e} recording message")
+                    traceback.print_exc()
+            now = time.time()
+            if now - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = now
+            if self.report_interval > 0 and now - last_report >= self.report_interval:
+                rate = (self.written - last_written) / (now - last_report)
+                print(f"Recorder: {rate:.1f} msgs/s, {self.written} written, {self.dropped} dropped, {self.queue.qsize()} queued")
+                last_written, last_report = self.written, now
+        for entry in self._open.values():
+            entry[0].close()
+        self._open = {}
+
+    def get_stats(self):
+        elapsed = time.time() - self._started if self._thread is not None else 0
+        with self._lock:
+            return {
+                "received": self.received,
+                "written": self.written,
+                "dropped": self.dropped,
+                "queued": self.queue.qsize(),
+                "bytes": self.bytes,
+                "files": list(self.files),
+                "msgs_per_second": self.written / elapsed if elapsed > 0 else 0,
+            }
+
+    def close(self):
+        """
+        Write the queued messages, close the files and print the final stats.
+        """
+        if self._thread is None:
+            return
+        self.queue.put(StopIteration)
+        self._thread.join()
+        stats = self.get_stats()
+        self._thread = None
+        print(f"Recorder: {stats['written']} messages written, {stats['dropped']} dropped, to {len(stats['files'])} files")
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+import os
+import json
+import glob
+import gzip
+import time
+import heapq
+import traceback
+
+def open_recording(path):
+    """
+    Open the JSON lines recording @param path for reading bytes, decompressing
+    .gz and .zst files.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+def find_recordings(paths):
+    """
+    Expand @param paths, a list of files, glob patterns or folders, into the
+    sorted list of recording files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [f for f in glob.glob(os.path.join(path, '*.jsonl*')) if os.path.isfile(f)]
+        else:
+            files += glob.glob(path) or [path]
+    return sorted(set(files))
+
+def read_recording(path, timestamp_field='analyticsTimestamp'):
+    """
+    Yield a (timestamp, body, data) tuple for each message of the recording
+    @param path. Messages without @param timestamp_field get the timestamp of
+    the previous message, zero before the first one with a timestamp.
+    """
+    timestamp = 0
+    with open_recording(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except Exception as e:
+                print(f"Skipping invalid line of {path}: {e}")
+                continue
+            if isinstance(data, dict) and data.get(timestamp_field) is not None:
+                timestamp = data[timestamp_field]
+            yield timestamp, line, data
+
+def read_recordings(paths, timestamp_field='analyticsTimestamp'):
+    """
+    Yield the messages of all recordings in @param paths (see find_recordings)
+    merged in timestamp order, as read_recording does.
+    """
+    readers = [read_recording(path, timestamp_field) for path in find_recordings(paths)]
+    return heapq.merge(*readers, key=lambda message: message[0])
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Return a dict of percentile to value of @param values for each of @param points.
+    """
+    values = sorted(values)
+    if not values:
+        return {point: 0 for point in points}
+    return {point: values[min(len(values) - 1, int(len(values) * point / 100))] for point in points}
+
+class Replay:
+    """
+    Replays recorded anypipe messages, as written by Recorder.JSONLRecorder
+    or aqueductRunner --json_dump, to a handler. Messages are paced by their
+    timestamp_field, in milliseconds, at speed times the original rate, a
+    speed of zero replays them as fast as possible.
+    """
+    speed = 1.0
+    timestamp_field = 'analyticsTimestamp'
+    # Only replay the messages of these sourceIds, all when empty
+    source_ids = []
+    # Print the stats every this many seconds while replaying, zero disables
+    report_interval = 10
+
+    def __init__(self, conf):
+        files = conf.get("files", [])
+        self.files = [files] if isinstance(files, str) else list(files)
+        self.speed = float(conf.get("speed", Replay.speed))
+        self.timestamp_field = conf.get("timestamp_field", Replay.timestamp_field)
+        self.source_ids = set(conf.get("source_ids", Replay.source_ids) or [])
+        self.report_interval = float(conf.get("report_interval", Replay.report_interval))
+        self._stopped = False
+        self.stats = None
+
+    def stop(self):
+        self._stopped = True
+
+    def replay(self, handler):
+        """
+        Call @param handler with the (body, data) of each message, the raw
+        line and its decoded JSON. Returns the stats, with the messages count,
+        the throughput, the percentiles in milliseconds of the handler latency,
+        and of the lag behind the original schedule. The schedule starts at the
+        first message with a timestamp, the messages without one are not paced.
+        """
+        self._stopped = False
+        latencies, lags = [], []
+        errors = 0
+        start = last_report = time.perf_counter()
+        first_timestamp = None
+        for timestamp, body, data in read_recordings(self.files, self.timestamp_field):
+            if self._stopped:
+                break
+            if self.source_ids and (not isinstance(data, dict) or data.get('sourceId') not in self.source_ids):
+                continue
+            timed = isinstance(data, dict) and data.get(self.timestamp_field) is not None
+            if self.speed > 0 and timed:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                    start = time.perf_counter()
+                due = start + (timestamp - first_timestamp) / 1000 / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lags.append(-delay * 1000)
+            t0 = time.perf_counter()
+            try:
+                handler(body, data)
+            except Exception as e:
+                errors += 1
+                print(f"Caught exception {e} handling replayed message")
+                traceback.print_exc()
+            now = time.perf_counter()
+            latencies.append((now - t0) * 1000)
+            if self.report_interval > 0 and now - last_report >= self.report_interval:
+                last_report = now
+                self.print_stats(self._stats(latencies, lags, errors, now - start))
+        self.stats = self._stats(latencies, lags, errors, time.perf_counter() - start)
+        return self.stats
+
+    def _stats(self, latencies, lags, errors, elapsed):
+        return {
+            "messages": len(latencies),
+            "errors": errors,
+            "seconds": elapsed,
+            "msgs_per_second": len(latencies) / elapsed if elapsed > 0 else 0,
+            "latency_ms": percentiles(latencies, (50, 90, 99, 100)),
+            "lag_ms": percentiles(lags, (50, 99, 100)),
+            "late": len(lags),
+        }
+
+    @staticmethod
+    def print_stats(stats):
+        latency, lag = stats["latency_ms"], stats["lag_ms"]
+        print(f"Replay: {stats['messages']} messages in {stats['seconds']:.1f}s, {stats['msgs_per_second']:.1f} msgs/s, "
+              f"{stats['errors']} errors. Latency ms p50 {latency[50]:.3f} p90 {latency[90]:.3f} p99 {latency[99]:.3f} "
+              f"max {latency[100]:.3f}. {stats['late']} late, lag ms p50 {lag[50]:.1f} p99 {lag[99]:.1f} max {lag[100]:.1f}")
+
+class ReplayListener(Replay):
+    """
+    In-process stand-in for AMQPListener, calling the json_callback with the
+    recorded messages instead of the ones of a broker.
+    """
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.json_callback = lambda data: print(f"Received data {data}")
+
+    def set_callback(self, json_callback):
+        self.json_callback = json_callback
+
+    def start(self):
+        """
+        Replay all the messages to the callback, returning the stats once done.
+        """
+        print(f"Replaying {self.files} at speed {self.speed or 'max'}")
+        stats = self.replay(lambda body, data: self.json_callback(data))
+        self.print_stats(stats)
+        return stats
+
+class ReplayPublisher(Replay):
+    """
+    Publishes the recorded messages to a broker, for the consumers connected
+    to it.
+    """
+    host = 'localhost'
+    port = 5672
+    username = 'guest'
+    password = 'guest'
+    exchange = 'anypipe'
+    routing_key = 'sio'
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.host = conf.get("host", ReplayPublisher.host)
+        self.port = int(conf.get("port", ReplayPublisher.port))
+        self.username = conf.get("username", ReplayPublisher.username)
+        self.password = conf.get("password", ReplayPublisher.password)
+        self.exchange = conf.get("exchange", ReplayPublisher.exchange)
+        self.routing_key = conf.get("routing_key", ReplayPublisher.routing_key)
+
+    def start(self):
+        """
+        Publish all the messages, returning the stats once done. The latencies
+        are the ones of the publish calls.
+        """
+        import pika
+        connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=self.host, port=self.port, credentials=pika.PlainCredentials(self.username, self.password)))
+        try:
+            channel = connection.channel()
+            channel.exchange_declare(exchange=self.exchange, exchange_type='topic', durable=True)
+            properties = pika.BasicProperties(content_type='application/json')
+            print(f"Replaying {self.files} to {self.host}:{self.port} exchange {self.exchange} at speed {self.speed or 'max'}")
+            stats = self.replay(lambda body, data: channel.basic_publish(
+                exchange=self.exchange, routing_key=self.routing_key, body=body, properties=properties))
+        finally:
+            connection.close()
+        self.print_stats(stats)
+        return stats
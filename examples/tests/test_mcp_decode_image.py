@@ -0,0 +1,53 @@
+import os
+import sys
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lib.MCP import MCPClient
+
+cv2 = pytest.importorskip("cv2")
+
+def encode(format, shape=(48, 64, 3)):
+    pixels = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format=format)
+    return buffer.getvalue()
+
+@pytest.fixture
+def png():
+    return encode("PNG")
+
+@pytest.fixture
+def client():
+    # No request is made to decode images
+    return MCPClient({"host": "localhost"})
+
+def decode(client, data, color, out, use_cv2, monkeypatch, reduce=1):
+    if not use_cv2:
+        # A None entry makes "import cv2" raise ImportError
+        monkeypatch.setitem(sys.modules, "cv2", None)
+    result = client.decode_image(data, color=color, reduce=reduce, out=out)
+    monkeypatch.undo()
+    return result
+
+@pytest.mark.parametrize("color", ["RGB", "BGR"])
+@pytest.mark.parametrize("preallocated", [False, True])
+def test_pil_fallback_matches_cv2(client, png, color, preallocated, monkeypatch):
+    out = np.zeros((48, 64, 3), np.uint8) if preallocated else None
+    expected = decode(client, png, color, None, True, monkeypatch)
+    result = decode(client, png, color, out, False, monkeypatch)
+    np.testing.assert_array_equal(result, expected)
+    if preallocated:
+        assert result is out
+
+@pytest.mark.parametrize("format", ["PNG", "JPEG"])
+@pytest.mark.parametrize("reduce", [2, 4, 8])
+def test_pil_fallback_reduces_like_cv2(client, format, reduce, monkeypatch):
+    data = encode(format, (49, 65, 3))
+    expected = decode(client, data, "RGB", None, True, monkeypatch, reduce)
+    result = decode(client, data, "RGB", None, False, monkeypatch, reduce)
+    assert result.shape == expected.shape